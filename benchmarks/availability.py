@@ -0,0 +1,118 @@
+"""Availability query time versus reservation table size.
+
+Seeds the reservation service schema with a growing number of reservations
+and times GET /hotel/available and the per-booking capacity check.
+
+    PYTHONPATH=. python benchmarks/availability.py --sizes 10000 100000 1000000
+
+Uses a temporary SQLite file unless DB_URL points at a (disposable) database.
+"""
+from datetime import datetime, timedelta
+from os import environ
+import argparse
+import importlib.util
+import json
+import os
+import random
+import tempfile
+import time
+
+
+def load_reservation_app(db_url):
+    environ['DB_URL'] = db_url
+    path = os.path.join(os.path.dirname(__file__), '..', 'reservation_service', 'app.py')
+    spec = importlib.util.spec_from_file_location('reservation_app', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def seed(module, hotels, reservations, start_id, rng):
+    base = datetime(2020, 1, 1)
+    rows = []
+    for i in range(reservations):
+        start = base + timedelta(days=rng.randrange(0, 365 * 5))
+        rows.append({
+            'reservation_uid': f'{start_id + i:032x}',
+            'username': f'user{rng.randrange(0, 10000)}',
+            'hotel_id': rng.randrange(1, hotels + 1),
+            'status': 'PAID' if rng.random() < 0.9 else 'CANCELED',
+            'start_date': start,
+            'end_date': start + timedelta(days=rng.randrange(1, 14))
+        })
+        if len(rows) == 10000:
+            module.db.session.execute(module.Reservation.__table__.insert(), rows)
+            rows = []
+    if rows:
+        module.db.session.execute(module.Reservation.__table__.insert(), rows)
+    module.db.session.commit()
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return samples[len(samples) // 2] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--hotels', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    db_url = environ.get('DB_URL') or f'sqlite:///{tempfile.mkdtemp()}/availability.db'
+    module = load_reservation_app(db_url)
+    client = module.app.test_client()
+    rng = random.Random(args.seed)
+
+    with module.app.app_context():
+        module.db.session.execute(module.Hotel.__table__.insert(), [
+            {
+                'hotel_uid': f'{i:032x}', 'name': f'Hotel {i}', 'country': 'Country', 'city': f'City {i % 50}',
+                'address': f'Street {i}', 'stars': i % 5 + 1, 'price': 1000 + i % 9000, 'rooms': rng.randrange(1, 50)
+            } for i in range(args.hotels)
+        ])
+        module.db.session.commit()
+
+    results = []
+    loaded = 0
+    for size in sorted(args.sizes):
+        with module.app.app_context():
+            seed(module, args.hotels, size - loaded, loaded, rng)
+        loaded = size
+
+        def search():
+            response = client.get('/hotel/available', query_string={
+                'start_date': '2022-06-01', 'end_date': '2022-06-08', 'city': 'City 7', 'per_page': 20
+            })
+            assert response.status_code == 200, response.get_data(as_text=True)
+
+        def check():
+            with module.app.app_context():
+                hotel = module.get_catalog_hotel(hotel_id=rng.randrange(1, args.hotels + 1))
+                module.has_free_room(hotel, datetime(2022, 6, 1), datetime(2022, 6, 8))
+                module.db.session.rollback()
+
+        result = {
+            'reservations': size,
+            'available_search_ms': round(timed(search, args.repeat), 3),
+            'booking_check_ms': round(timed(check, args.repeat), 3)
+        }
+        results.append(result)
+        print(f"{size:>10} reservations  search {result['available_search_ms']:8.3f} ms  "
+              f"booking check {result['booking_check_ms']:8.3f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'db': module.db.engine.dialect.name, 'hotels': args.hotels, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""Load test of the booking flow across the loyalty, payment and reservation services.
+
+Starts the three Flask apps on local ports (SQLite files in WAL mode stand in
+for Postgres unless --db-url is given), seeds a dataset of hotels and loyalty
+users through the bulk endpoints, then replays a weighted mix of operations
+with a fixed number of concurrent clients:
+
+    list_hotels     GET /hotel
+    loyalty_lookup  GET /loyalty/<username>
+    book            POST /reservation
+    cancel          DELETE /reservations/<uid>
+    pay             POST /payment
+    refund          DELETE /payment/<uid>
+
+Throughput and p50/p95/p99 latency per operation are printed and written as
+JSON, so runs can be compared before a deployment.
+
+    PYTHONPATH=. python benchmarks/booking_flow.py --hotels 1000 --users 1000 \\
+        --requests 5000 --concurrency 50 --mix book=30,list_hotels=30,loyalty_lookup=20,cancel=10,pay=5,refund=5
+
+The run is reproducible for a given --seed, up to the interleaving of the
+concurrent clients.
+"""
+from datetime import date, timedelta
+from os import environ
+import argparse
+import asyncio
+import json
+import random
+import sys
+import tempfile
+import time
+import httpx
+from harness import ROOT, WSGI_LAUNCHER, PORTS, local_url, sqlite_url, start, stop, wait_ready, percentile
+
+
+DEFAULT_MIX = 'list_hotels=30,loyalty_lookup=20,book=25,cancel=10,pay=10,refund=5'
+CITIES = ['Moscow', 'Paris', 'Berlin', 'Rome', 'Madrid', 'Vienna', 'Prague', 'Lisbon']
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}, expected one of {', '.join(OPERATIONS)}")
+        mix[name] = float(weight)
+    return mix
+
+
+def ndjson(rows):
+    return ''.join(json.dumps(row) + '\n' for row in rows)
+
+
+def seed(hotels, users, rng):
+    hotel_rows = [{
+        'name': f'Hotel {i}',
+        'country': 'Country',
+        'city': rng.choice(CITIES),
+        'address': f'Street {i}',
+        'stars': rng.randint(1, 5),
+        'price': rng.randrange(1000, 20000, 100)
+    } for i in range(hotels)]
+    user_rows = [{
+        'username': f'user{i}',
+        'reservation_count': 0,
+        'status': 'BRONZE',
+        'discount': 5
+    } for i in range(users)]
+
+    headers = {'Content-Type': 'application/x-ndjson'}
+    for url, rows in [(f"{local_url('reservation')}/hotel/bulk", hotel_rows), (f"{local_url('loyalty')}/loyalty/bulk", user_rows)]:
+        response = httpx.post(url, content=ndjson(rows), headers=headers, timeout=300)
+        response.raise_for_status()
+
+
+#state shared by the clients: bookings that can be cancelled or paid, payments that can be refunded
+class Workload:
+    def __init__(self, hotels, users):
+        self.hotels = hotels
+        self.users = users
+        self.reservations = []
+        self.payments = []
+
+    def username(self, rng):
+        return f'user{rng.randrange(self.users)}'
+
+
+async def list_hotels(client, workload, rng):
+    return await client['reservation'].get('/hotel', params={'city': rng.choice(CITIES), 'page': rng.randint(1, 3)})
+
+
+async def loyalty_lookup(client, workload, rng):
+    return await client['loyalty'].get(f'/loyalty/{workload.username(rng)}')
+
+
+async def book(client, workload, rng):
+    username = workload.username(rng)
+    start_date = date(2024, 1, 1) + timedelta(days=rng.randrange(365))
+    response = await client['reservation'].post('/reservation', headers={'X-User-Name': username}, json={
+        'hotel_id': rng.randint(1, workload.hotels),
+        'start_date': start_date.isoformat(),
+        'end_date': (start_date + timedelta(days=rng.randint(1, 7))).isoformat()
+    })
+    if response.status_code == 201:
+        body = response.json()
+        workload.reservations.append((body['id'], body['reservation_uid'], username))
+    return response
+
+
+async def cancel(client, workload, rng):
+    if not workload.reservations:
+        return None
+    _, reservation_uid, username = workload.reservations.pop(rng.randrange(len(workload.reservations)))
+    return await client['reservation'].delete(f'/reservations/{reservation_uid}', headers={'X-User-Name': username})
+
+
+async def pay(client, workload, rng):
+    if not workload.reservations:
+        return None
+    reservation_id, _, username = workload.reservations.pop(rng.randrange(len(workload.reservations)))
+    response = await client['payment'].post('/payment', json={'reservation_id': reservation_id, 'price': 1000})
+    if response.status_code == 201:
+        workload.payments.append((response.json()['payment_uid'], username))
+    return response
+
+
+async def refund(client, workload, rng):
+    if not workload.payments:
+        return None
+    payment_uid, username = workload.payments.pop(rng.randrange(len(workload.payments)))
+    return await client['payment'].delete(f'/payment/{payment_uid}', headers={'X-User-Name': username})
+
+
+OPERATIONS = {
+    'list_hotels': list_hotels,
+    'loyalty_lookup': loyalty_lookup,
+    'book': book,
+    'cancel': cancel,
+    'pay': pay,
+    'refund': refund
+}
+
+
+async def run(workload, mix, requests_count, warmup, concurrency, seed_value):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    samples = {name: [] for name in names}
+    statuses = {name: {} for name in names}
+    skipped = {name: 0 for name in names}
+    remaining = [requests_count + warmup]
+    done = [0]
+    measured_from = [time.perf_counter()]
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    clients = {service: httpx.AsyncClient(base_url=local_url(service), limits=limits, timeout=60) for service in PORTS}
+
+    async def worker(index):
+        rng = random.Random(seed_value * 1000 + index)
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            name = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            response = await OPERATIONS[name](clients, workload, rng)
+            elapsed = time.perf_counter() - started
+            done[0] += 1
+            if done[0] <= warmup:
+                if done[0] == warmup:
+                    measured_from[0] = time.perf_counter()
+                continue
+            if response is None:
+                # nothing to cancel, pay or refund yet
+                skipped[name] += 1
+                continue
+            samples[name].append(elapsed)
+            statuses[name][response.status_code] = statuses[name].get(response.status_code, 0) + 1
+
+    try:
+        await asyncio.gather(*[worker(i) for i in range(concurrency)])
+        elapsed = time.perf_counter() - measured_from[0]
+    finally:
+        for client in clients.values():
+            await client.aclose()
+
+    operations = {}
+    for name in names:
+        latencies = sorted(samples[name])
+        if not latencies:
+            operations[name] = {'requests': 0, 'skipped': skipped[name]}
+            continue
+        operations[name] = {
+            'requests': len(latencies),
+            'skipped': skipped[name],
+            'throughput_rps': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'statuses': statuses[name]
+        }
+    total = sum(len(latencies) for latencies in samples.values())
+    return {
+        'seconds': round(elapsed, 3),
+        'requests': total,
+        'throughput_rps': round(total / elapsed, 1),
+        'operations': operations
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hotels', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--warmup', type=int, default=200, help='operations run before measuring')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'default {DEFAULT_MIX}')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db-url', help='database URL template with {service}, e.g. postgresql://u:p@localhost/{service}')
+    parser.add_argument('--output', default='booking_flow.json', help='JSON results file')
+    parser.add_argument('--admission', action='store_true', help='keep admission control on, 429/503 then show up per operation')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    env = dict(environ, PYTHONPATH=ROOT, OUTBOX_POLL_INTERVAL='0.2', ADMISSION_ENABLED='1' if args.admission else '0')
+    for service in PORTS:
+        env[f'{service.upper()}_SERVICE_BASE_URL'] = local_url(service)
+
+    processes = []
+    try:
+        for service, port in PORTS.items():
+            db_url = args.db_url.format(service=service) if args.db_url else sqlite_url(f'{tmp}/{service}.db')
+            processes.append(start(service, [sys.executable, '-c', WSGI_LAUNCHER, str(port)], dict(env, DB_URL=db_url)))
+        for service in PORTS:
+            wait_ready(f'{local_url(service)}/metrics')
+
+        seed(args.hotels, args.users, random.Random(args.seed))
+        workload = Workload(args.hotels, args.users)
+        result = asyncio.run(run(workload, args.mix, args.requests, args.warmup, args.concurrency, args.seed))
+    finally:
+        for process in processes:
+            stop(process)
+
+    result['config'] = {
+        'hotels': args.hotels,
+        'users': args.users,
+        'concurrency': args.concurrency,
+        'warmup': args.warmup,
+        'mix': args.mix,
+        'seed': args.seed,
+        'database': 'custom' if args.db_url else 'sqlite'
+    }
+    print(f"{'operation':>15} {'requests':>9} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  statuses")
+    for name, stats in result['operations'].items():
+        if stats['requests']:
+            print(f"{name:>15} {stats['requests']:>9} {stats['throughput_rps']:>8.1f} {stats['p50_ms']:>9.2f} "
+                  f"{stats['p95_ms']:>9.2f} {stats['p99_ms']:>9.2f}  {stats['statuses']}")
+    print(f"{'total':>15} {result['requests']:>9} {result['throughput_rps']:>8.1f}")
+
+    with open(args.output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
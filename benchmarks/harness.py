@@ -0,0 +1,56 @@
+"""Helpers shared by the benchmarks that run the services as real processes."""
+import os
+import sqlite3
+import subprocess
+import time
+import httpx
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+PORTS = {'loyalty': 18050, 'payment': 18060, 'reservation': 18070}
+WSGI_LAUNCHER = (
+    "import sys; from werkzeug.serving import run_simple; import app; "
+    "run_simple('127.0.0.1', int(sys.argv[1]), app.app, threaded=True)"
+)
+
+
+def local_url(service):
+    return f'http://127.0.0.1:{PORTS[service]}'
+
+
+#file-backed SQLite stand-in for Postgres; WAL is stored in the file, so the service picks it up
+def sqlite_url(path):
+    sqlite3.connect(path).execute('PRAGMA journal_mode=WAL').close()
+    return f'sqlite:///{path}?timeout=30'
+
+
+def start(service, command, env):
+    return subprocess.Popen(
+        command,
+        cwd=os.path.join(ROOT, f'{service}_service'),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
+
+def stop(process):
+    process.terminate()
+    process.wait()
+
+
+def wait_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f'{url} did not come up')
+
+
+#nearest-rank percentile of sorted samples
+def percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
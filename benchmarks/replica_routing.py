@@ -0,0 +1,116 @@
+"""Read routing between a primary and a read replica, on two local SQLite files.
+
+Starts the loyalty service with DB_URL and DB_REPLICA_URL pointing at separate
+files and copies the primary into the replica only when told to, so every read
+shows where it went: a user created on the primary is missing on the replica
+until the next copy. Checks that
+
+- writes go to the primary,
+- @read_only routes read from the replica,
+- the writer reads its own write from the primary for DB_REPLICA_STICKY_SECONDS,
+- X-Read-Consistency: primary reads from the primary,
+
+and that the /manage/db routing counters agree.
+
+    PYTHONPATH=. python benchmarks/replica_routing.py
+
+Needs the loyalty service requirements (plus httpx).
+"""
+from os import environ
+import argparse
+import sqlite3
+import sys
+import tempfile
+import time
+import httpx
+from harness import ROOT, WSGI_LAUNCHER, PORTS, sqlite_url, start, stop, wait_ready
+
+
+#stand-in for replication: copy the primary file into the replica with SQLite's backup API
+def replicate(primary, replica):
+    source = sqlite3.connect(primary)
+    target = sqlite3.connect(replica)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+
+
+def has_user(path, username):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute('SELECT 1 FROM loyalty WHERE username = ?', (username,)).fetchone() is not None
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=PORTS['loyalty'])
+    parser.add_argument('--sticky-seconds', type=float, default=1.0)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    primary, replica = f'{tmp}/primary.db', f'{tmp}/replica.db'
+    env = dict(
+        environ, PYTHONPATH=ROOT,
+        DB_URL=sqlite_url(primary), DB_REPLICA_URL=sqlite_url(replica),
+        DB_REPLICA_STICKY_SECONDS=str(args.sticky_seconds)
+    )
+    base_url = f'http://127.0.0.1:{args.port}'
+    failures = []
+
+    def check(label, response, expected_status):
+        ok = response.status_code == expected_status
+        print(f"{'ok' if ok else 'FAIL':>4}  {label}: {response.status_code} (expected {expected_status})")
+        if not ok:
+            failures.append(label)
+
+    def headers(username, consistency=None):
+        values = {'X-User-Name': username}
+        if consistency:
+            values['X-Read-Consistency'] = consistency
+        return values
+
+    service = start('loyalty', [sys.executable, '-c', WSGI_LAUNCHER, str(args.port)], env)
+    try:
+        wait_ready(f'{base_url}/manage/db')
+        # the service created its schema on the primary, the replica starts as a copy of it
+        replicate(primary, replica)
+
+        check('write by bob', httpx.post(f'{base_url}/loyalty', json={
+            'username': 'bob', 'reservation_count': 0, 'status': 'BRONZE', 'discount': 5
+        }, headers=headers('bob')), 201)
+        print(f"      bob on the primary: {has_user(primary, 'bob')}, on the replica: {has_user(replica, 'bob')}")
+        if not has_user(primary, 'bob') or has_user(replica, 'bob'):
+            failures.append('write went to the primary only')
+
+        check('bob reads his write (sticky, primary)', httpx.get(f'{base_url}/loyalty/bob', headers=headers('bob')), 200)
+        check('amy reads bob (replica, not replicated yet)', httpx.get(f'{base_url}/loyalty/bob', headers=headers('amy')), 404)
+        check('amy reads bob with X-Read-Consistency: primary',
+              httpx.get(f'{base_url}/loyalty/bob', headers=headers('amy', 'primary')), 200)
+
+        time.sleep(args.sticky_seconds + 0.5)
+        check('bob after the sticky window (replica)', httpx.get(f'{base_url}/loyalty/bob', headers=headers('bob')), 404)
+
+        replicate(primary, replica)
+        check('amy reads bob after replication (replica)', httpx.get(f'{base_url}/loyalty/bob', headers=headers('amy')), 200)
+
+        routing = httpx.get(f'{base_url}/manage/db').json()['read_routing']
+        expected = {'replica': 3, 'primary': 1, 'sticky': 1}
+        ok = routing == expected
+        print(f"{'ok' if ok else 'FAIL':>4}  routing counters: {routing} (expected {expected})")
+        if not ok:
+            failures.append('routing counters')
+    finally:
+        stop(service)
+
+    if failures:
+        print(f"{len(failures)} check(s) failed")
+        sys.exit(1)
+    print('all checks passed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Booking throughput of the reservation service, sync (threaded WSGI) vs async (ASGI).
+
+Starts the reservation service in each mode on a local port with a stub
+loyalty service that answers after a fixed delay (standing in for network and
+loyalty latency), seeds a hotel, then fires POST /reservation with a fixed
+number of concurrent clients. Every booking uses a fresh username, so each
+one pays the loyalty lookup.
+
+    PYTHONPATH=. python benchmarks/serving_modes.py --requests 2000 --concurrency 200
+
+Needs the reservation service requirements (quart, uvicorn, httpx, ...).
+"""
+from os import environ
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import threading
+import time
+import httpx
+import uvicorn
+from harness import ROOT, WSGI_LAUNCHER, PORTS, local_url, sqlite_url, start, stop, wait_ready, percentile
+
+
+#answers every loyalty call with a known user after delay seconds
+def loyalty_stub(delay):
+    async def stub(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        await asyncio.sleep(delay)
+        username = scope['path'].split('/')[2]
+        body = json.dumps({
+            'id': 1, 'username': username, 'reservation_count': 0, 'status': 'BRONZE', 'discount': 5
+        }).encode()
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': body})
+    return stub
+
+
+def start_stub(delay, port):
+    server = uvicorn.Server(uvicorn.Config(loyalty_stub(delay), port=port, log_level='warning', lifespan='off'))
+    threading.Thread(target=server.run, daemon=True).start()
+    return server
+
+
+async def load(base_url, requests_count, concurrency, run_id):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    latencies = []
+    statuses = {}
+    queue = asyncio.Queue()
+    for i in range(requests_count):
+        queue.put_nowait(i)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def worker():
+            while not queue.empty():
+                i = queue.get_nowait()
+                started = time.perf_counter()
+                response = await client.post(
+                    '/reservation',
+                    json={'hotel_id': 1, 'start_date': '2021-10-08', 'end_date': '2021-10-11'},
+                    headers={'X-User-Name': f'{run_id}-user{i}'}
+                )
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests_count,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(requests_count / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'statuses': statuses
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--modes', nargs='+', default=['sync', 'async'])
+    parser.add_argument('--loyalty-delay', type=float, default=0.05, help='stub loyalty latency in seconds')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    env = dict(environ, PYTHONPATH=ROOT, LOYALTY_SERVICE_BASE_URL=local_url('loyalty'))
+    stub = start_stub(args.loyalty_delay, PORTS['loyalty'])
+    results = []
+    try:
+        for mode in args.modes:
+            service_env = dict(env, DB_URL=sqlite_url(f'{tmp}/reservation-{mode}.db'))
+            port = str(PORTS['reservation'])
+            if mode == 'async':
+                command = [sys.executable, '-m', 'uvicorn', 'async_app:application', '--port', port,
+                           '--log-level', 'warning', '--timeout-keep-alive', '60']
+            else:
+                command = [sys.executable, '-c', WSGI_LAUNCHER, port]
+            reservation = start('reservation', command, service_env)
+            base_url = local_url('reservation')
+            try:
+                wait_ready(f'{base_url}/test')
+                httpx.post(f'{base_url}/hotel', json={
+                    'name': 'Hotel', 'country': 'Country', 'city': 'City', 'address': 'Street', 'stars': 5, 'price': 1000
+                }).raise_for_status()
+                result = dict(asyncio.run(load(base_url, args.requests, args.concurrency, mode)), mode=mode)
+                results.append(result)
+                print(f"{mode:>6}: {result['throughput_rps']:8.1f} req/s  p50 {result['p50_ms']:8.2f} ms  "
+                      f"p99 {result['p99_ms']:8.2f} ms  statuses {result['statuses']}")
+            finally:
+                stop(reservation)
+    finally:
+        stub.should_exit = True
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+from flask import g, request, jsonify, make_response
+from collections import namedtuple
+from os import environ
+import asyncio
+import math
+import threading
+import time
+from common.cache import create_cache, MISSING
+from common.metrics import REGISTRY
+
+
+# concurrency: requests of the route running at once, rate/burst: token bucket per X-User-Name
+Limit = namedtuple('Limit', 'concurrency rate burst', defaults=(None, None, None))
+
+ADMISSION_ENABLED = environ.get('ADMISSION_ENABLED', '1') != '0'
+# how many requests may wait for a slot, and for how long, before the route sheds load
+ADMISSION_MAX_QUEUE = int(environ.get('ADMISSION_MAX_QUEUE', 32))
+ADMISSION_MAX_WAIT = float(environ.get('ADMISSION_MAX_WAIT', 0.5))
+ADMISSION_RETRY_AFTER = int(environ.get('ADMISSION_RETRY_AFTER', 1))
+
+admission_rejections = REGISTRY.counter('admission_rejections_total', 'Requests turned away by route and reason.')
+admission_queue_time = REGISTRY.histogram('admission_queue_seconds', 'Time admitted requests waited for a slot, by route.')
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    #0 when a token was taken, otherwise the seconds until the next one
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+#admission state of one route
+class RouteAdmission:
+    def __init__(self, endpoint, limit, max_queue, max_wait):
+        self.endpoint = endpoint
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.slots = threading.BoundedSemaphore(limit.concurrency) if limit.concurrency else None
+        # idle buckets are dropped once they would be full again anyway
+        self.buckets = create_cache(
+            f'admission-{endpoint}', int(environ.get('ADMISSION_BUCKETS_SIZE', 100000)),
+            limit.burst / limit.rate + 1
+        ) if limit.rate else None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = {'rate_limited': 0, 'queue_full': 0, 'queue_timeout': 0}
+
+    def _reject(self, reason):
+        with self._lock:
+            self.rejected[reason] += 1
+
+    #seconds the user has to wait for a token, 0 when the request may go on
+    def check_rate(self, user):
+        if self.buckets is None or not user:
+            return 0.0
+        with self._lock:
+            bucket = self.buckets.get(user)
+            if bucket is MISSING:
+                bucket = TokenBucket(self.limit.rate, self.limit.burst)
+            wait = bucket.take()
+            self.buckets.set(user, bucket)
+        if wait:
+            self._reject('rate_limited')
+        return wait
+
+    #(admitted, reason, seconds waited) - waits at most max_wait, and only behind max_queue others
+    def acquire(self):
+        if self.slots is not None and not self.slots.acquire(blocking=False):
+            return self._wait_for_slot()
+        return self._admit(0.0)
+
+    #acquire() for an event loop, a request that has to queue waits on a worker thread
+    async def acquire_async(self):
+        if self.slots is not None and not self.slots.acquire(blocking=False):
+            waiter = asyncio.ensure_future(asyncio.to_thread(self._wait_for_slot))
+            try:
+                return await asyncio.shield(waiter)
+            except asyncio.CancelledError:
+                # the thread cannot be stopped, a slot it still gets is handed back right away
+                waiter.add_done_callback(self._release_abandoned)
+                raise
+        return self._admit(0.0)
+
+    def _release_abandoned(self, waiter):
+        if not waiter.cancelled() and waiter.exception() is None and waiter.result()[0]:
+            self.release()
+
+    def _wait_for_slot(self):
+        with self._lock:
+            if self.waiting >= self.max_queue:
+                self.rejected['queue_full'] += 1
+                return False, 'queue_full', 0.0
+            self.waiting += 1
+        started = time.perf_counter()
+        acquired = self.slots.acquire(timeout=self.max_wait)
+        waited = time.perf_counter() - started
+        with self._lock:
+            self.waiting -= 1
+        if not acquired:
+            self._reject('queue_timeout')
+            return False, 'queue_timeout', waited
+        return self._admit(waited)
+
+    def _admit(self, waited):
+        with self._lock:
+            self.in_flight += 1
+            self.admitted += 1
+        return True, None, waited
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        if self.slots is not None:
+            self.slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'concurrency': self.limit.concurrency,
+                'rate': self.limit.rate,
+                'burst': self.limit.burst,
+                'in_flight': self.in_flight,
+                'waiting': self.waiting,
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+                'users_tracked': len(self.buckets) if self.buckets is not None else 0
+            }
+
+
+#limits from code, ADMISSION_<ENDPOINT>_CONCURRENCY / _RATE / _BURST override them
+def _limit(endpoint, limit):
+    def setting(key, default, cast):
+        value = environ.get(f'ADMISSION_{endpoint.upper()}_{key}')
+        return cast(value) if value is not None else default
+
+    concurrency = setting('CONCURRENCY', limit.concurrency, int)
+    rate = setting('RATE', limit.rate, float)
+    burst = setting('BURST', limit.burst, float)
+    if rate and not burst:
+        burst = max(1.0, rate)
+    return Limit(concurrency or None, rate or None, burst if rate else None)
+
+
+def retry_after(seconds):
+    return str(max(1, math.ceil(seconds)))
+
+
+def _too_busy(message, status, seconds):
+    response = make_response(jsonify({'message': message}), status)
+    response.headers['Retry-After'] = retry_after(seconds)
+    return response
+
+
+#per-route concurrency limits with bounded queueing and per-user rate limits, keyed by view function name
+#returns the routes' admission state, so another server of the same views can share it
+def register_admission(app, limits):
+    routes = {
+        endpoint: RouteAdmission(endpoint, _limit(endpoint, limit), ADMISSION_MAX_QUEUE, ADMISSION_MAX_WAIT)
+        for endpoint, limit in limits.items()
+    }
+
+    @app.before_request
+    def admit():
+        route = routes.get(request.endpoint) if ADMISSION_ENABLED else None
+        if route is None:
+            return None
+        rule = (('route', request.url_rule.rule),)
+
+        wait = route.check_rate(request.headers.get('X-User-Name'))
+        if wait:
+            REGISTRY.inc(admission_rejections, rule + (('reason', 'rate_limited'),))
+            return _too_busy('Too many requests, slow down', 429, wait)
+
+        admitted, reason, waited = route.acquire()
+        if not admitted:
+            REGISTRY.inc(admission_rejections, rule + (('reason', reason),))
+            return _too_busy('Service is busy, try again later', 503, ADMISSION_RETRY_AFTER)
+        REGISTRY.observe(admission_queue_time, rule, waited)
+        g.admission_route = route
+        return None
+
+    @app.after_request
+    def hold_while_streaming(response):
+        # a streamed body is produced after the view returned, its slot is given back when the response closes
+        if response.is_streamed:
+            route = g.pop('admission_route', None)
+            if route is not None:
+                response.call_on_close(route.release)
+        return response
+
+    @app.teardown_request
+    def release(exc):
+        route = g.pop('admission_route', None)
+        if route is not None:
+            route.release()
+
+    def admission_stats():
+        return make_response(jsonify({
+            'enabled': ADMISSION_ENABLED,
+            'max_queue': ADMISSION_MAX_QUEUE,
+            'max_wait': ADMISSION_MAX_WAIT,
+            'routes': {endpoint: route.stats() for endpoint, route in routes.items()}
+        }), 200)
+    app.add_url_rule('/manage/admission', 'admission_stats', admission_stats, methods=['GET'])
+    return routes
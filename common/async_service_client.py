@@ -0,0 +1,119 @@
+import threading
+import time
+import httpx
+from common.service_client import CircuitBreaker, ServiceUnavailableError, service_url, is_load_shed, _setting, register_client
+from common.metrics import observe_outbound
+from common.tracing import start_span
+
+
+#asyncio counterpart of ServiceClient, for the async serving mode
+class AsyncServiceClient:
+    def __init__(self, name, base_url, pool_size=100, connect_timeout=1.0, read_timeout=5.0, pool_timeout=30.0,
+                 retries=2, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        # pool_timeout bounds the wait for a free connection when all of them are in use
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout, pool=pool_timeout)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.retries = retries
+        self.client = None
+
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    #the connection pool is bound to the running event loop, so it is opened on startup
+    def open(self):
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            trust_env=False,
+            # httpx only retries failed connects, which is safe for every method
+            transport=httpx.AsyncHTTPTransport(retries=self.retries)
+        )
+
+    async def aclose(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    #one client span per call, its id travels to the target as the parent of the target's span
+    async def request(self, method, path, **kwargs):
+        with start_span(f'{method} {self.name}', 'client', target=self.name, path=path) as span:
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, traceparent=span.traceparent())
+            response = await self._send(method, path, **kwargs)
+            span.attributes['status'] = response.status_code
+            return response
+
+    async def _send(self, method, path, **kwargs):
+        if not self.breaker.allow_request():
+            raise ServiceUnavailableError(f'{self.name} service is unavailable (circuit open)')
+
+        with self._lock:
+            self.requests += 1
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, **kwargs)
+        except httpx.PoolTimeout:
+            # our own pool is saturated, that says nothing about the target's health
+            observe_outbound(self.name, method, 'error', time.perf_counter() - started)
+            with self._lock:
+                self.errors += 1
+            self.breaker.release_probe()
+            raise
+        except httpx.HTTPError:
+            observe_outbound(self.name, method, 'error', time.perf_counter() - started)
+            with self._lock:
+                self.errors += 1
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            # cancelled or failed before reaching the target, a probe must not stay in flight forever
+            self.breaker.release_probe()
+            raise
+        observe_outbound(self.name, method, response.status_code, time.perf_counter() - started)
+
+        if response.status_code >= 500 and not is_load_shed(response):
+            with self._lock:
+                self.errors += 1
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    async def get(self, path, **kwargs):
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request('POST', path, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            counters = {'requests': self.requests, 'errors': self.errors}
+        return {
+            'base_url': self.base_url,
+            'connect_timeout': self.timeout.connect,
+            'read_timeout': self.timeout.read,
+            'pool_timeout': self.timeout.pool,
+            'max_connections': self.pool_size,
+            'counters': counters,
+            'circuit_breaker': self.breaker.stats()
+        }
+
+
+def async_service_client(name):
+    client = AsyncServiceClient(
+        name,
+        service_url(name),
+        pool_size=_setting(name, 'ASYNC_HTTP_POOL_SIZE', 100, int),
+        connect_timeout=_setting(name, 'HTTP_CONNECT_TIMEOUT', 1.0, float),
+        read_timeout=_setting(name, 'HTTP_READ_TIMEOUT', 5.0, float),
+        pool_timeout=_setting(name, 'ASYNC_HTTP_POOL_TIMEOUT', 30.0, float),
+        retries=_setting(name, 'HTTP_RETRIES', 2, int),
+        failure_threshold=_setting(name, 'HTTP_BREAKER_THRESHOLD', 5, int),
+        reset_timeout=_setting(name, 'HTTP_BREAKER_RESET', 30.0, float)
+    )
+    register_client(f'{name}-async', client)
+    return client
@@ -0,0 +1,25 @@
+from os import environ
+
+
+MAX_BATCH_SIZE = int(environ.get('MAX_BATCH_SIZE', 1000))
+
+
+#deduplicated keys from data[field], in request order
+def batch_keys(data, field, cast=str):
+    keys = data.get(field) if isinstance(data, dict) else None
+    if not isinstance(keys, list):
+        raise ValueError(f'{field} must be a list')
+    if len(keys) > MAX_BATCH_SIZE:
+        raise ValueError(f'At most {MAX_BATCH_SIZE} {field} per request')
+    try:
+        return list(dict.fromkeys(cast(key) for key in keys))
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid value in {field}')
+
+
+#{"found": {key: item}, "missing": [keys]} with string keys for JSON
+def keyed_response(keys, found):
+    return {
+        'found': {str(key): found[key] for key in keys if key in found},
+        'missing': [key for key in keys if key not in found]
+    }
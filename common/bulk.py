@@ -0,0 +1,114 @@
+from os import environ
+import json
+
+
+BULK_CHUNK_SIZE = int(environ.get('BULK_CHUNK_SIZE', 1000))
+# per-row errors beyond this are only counted
+BULK_MAX_ERRORS = int(environ.get('BULK_MAX_ERRORS', 1000))
+
+
+class BulkReport:
+    def __init__(self):
+        self.received = 0
+        self.inserted = 0
+        self.error_count = 0
+        self.errors = []
+
+    def error(self, row, message):
+        self.error_count += 1
+        if len(self.errors) < BULK_MAX_ERRORS:
+            self.errors.append({'row': row, 'message': message})
+
+    def json(self):
+        return {
+            'received': self.received,
+            'inserted': self.inserted,
+            'failed': self.error_count,
+            'errors': self.errors
+        }
+
+
+#(row number, item, error) from a JSON array body or a streamed NDJSON body
+def bulk_rows(request):
+    if request.mimetype in ('application/x-ndjson', 'application/ndjson', 'application/jsonlines'):
+        number = 0
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield number, json.loads(line), None
+            except ValueError as e:
+                yield number, None, f'Invalid JSON: {str(e)}'
+            number += 1
+        return
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        raise ValueError('Body must be a JSON array or NDJSON')
+    for number, item in enumerate(data):
+        yield number, item, None
+
+
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+#validate(item) -> (row, error); existing_keys(keys) -> set of keys already stored
+def bulk_ingest(request, session, table, key, validate, existing_keys, on_insert=None):
+    report = BulkReport()
+    seen = set()
+
+    for chunk in chunked(bulk_rows(request), BULK_CHUNK_SIZE):
+        candidates = []
+        for number, item, error in chunk:
+            report.received += 1
+            if error is None:
+                if isinstance(item, dict):
+                    row, error = validate(item)
+                else:
+                    error = 'Row must be a JSON object'
+            if error is not None:
+                report.error(number, error)
+            elif row[key] in seen:
+                report.error(number, f'Duplicate {key} {row[key]} in request')
+            else:
+                seen.add(row[key])
+                candidates.append((number, row))
+
+        if not candidates:
+            continue
+
+        # one set-based lookup per chunk instead of one query per row
+        existing = existing_keys([row[key] for _, row in candidates])
+        rows = []
+        for number, row in candidates:
+            if row[key] in existing:
+                report.error(number, f'{key} {row[key]} already exists')
+            else:
+                rows.append((number, row))
+
+        if not rows:
+            continue
+        try:
+            session.execute(table.insert(), [row for _, row in rows])
+            if on_insert:
+                # bookkeeping that has to commit together with the rows
+                on_insert([row for _, row in rows])
+            session.commit()
+            report.inserted += len(rows)
+        except Exception as e:
+            session.rollback()
+            # the DBAPI error, without the statement and its thousands of parameters
+            message = f'Insert failed: {str(getattr(e, "orig", e))}'
+            for number, _ in rows:
+                report.error(number, message)
+
+    return report
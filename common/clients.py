@@ -0,0 +1,25 @@
+from flask import jsonify, make_response
+import threading
+
+
+#every outbound client of the process by name, for /manage/http-clients
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+#expose another client (e.g. the asyncio one) on /manage/http-clients
+def register_client(name, client):
+    with _clients_lock:
+        _clients[name] = client
+
+
+def client_stats():
+    with _clients_lock:
+        clients = dict(_clients)
+    return {name: client.stats() for name, client in clients.items()}
+
+
+def register_client_stats_route(app):
+    def http_client_stats():
+        return make_response(jsonify(client_stats()), 200)
+    app.add_url_rule('/manage/http-clients', 'http_client_stats', http_client_stats, methods=['GET'])
@@ -0,0 +1,55 @@
+from sqlalchemy import select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+_UPSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+#add deltas to the counter row identified by keys, creating the row on first use
+def upsert_increment(session, table, keys, deltas):
+    insert = _UPSERTS.get(session.get_bind().dialect.name)
+    if insert is not None:
+        statement = insert(table).values(**keys, **deltas)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={column: table.c[column] + statement.excluded[column] for column in deltas}
+        )
+        session.execute(statement)
+        return
+
+    updated = session.execute(
+        update(table)
+        .where(*[table.c[column] == value for column, value in keys.items()])
+        .values({column: table.c[column] + delta for column, delta in deltas.items()})
+    )
+    if updated.rowcount == 0:
+        session.execute(table.insert().values(**keys, **deltas))
+
+
+#write values to the row identified by keys unless the stored row carries a newer version; False when it was stale
+def upsert_newer(session, table, keys, values, version):
+    insert = _UPSERTS.get(session.get_bind().dialect.name)
+    if insert is not None:
+        statement = insert(table).values(**keys, **values)
+        statement = statement.on_conflict_do_update(
+            index_elements=list(keys),
+            set_={column: statement.excluded[column] for column in values},
+            where=table.c[version] <= statement.excluded[version]
+        )
+        return session.execute(statement).rowcount > 0
+
+    updated = session.execute(
+        update(table)
+        .where(*[table.c[column] == value for column, value in keys.items()])
+        .where(table.c[version] <= values[version])
+        .values(values)
+    )
+    if updated.rowcount:
+        return True
+    exists = session.execute(
+        select(table.c[next(iter(keys))]).where(*[table.c[column] == value for column, value in keys.items()])
+    ).first()
+    if exists:
+        return False
+    session.execute(table.insert().values(**keys, **values))
+    return True
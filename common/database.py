@@ -0,0 +1,96 @@
+from flask import current_app, g, request, has_request_context, jsonify, make_response
+from flask_sqlalchemy.session import Session
+from functools import wraps
+from os import environ
+import threading
+from common.cache import create_cache
+
+
+REPLICA = 'replica'
+
+# after a write, the same user reads from the primary for this long
+REPLICA_STICKY_SECONDS = float(environ.get('DB_REPLICA_STICKY_SECONDS', 5))
+recent_writers = create_cache('replica-sticky', int(environ.get('DB_REPLICA_STICKY_SIZE', 100000)), REPLICA_STICKY_SECONDS)
+
+_routing = {'replica': 0, 'primary': 0, 'sticky': 0}
+_routing_lock = threading.Lock()
+
+
+def _count(key):
+    with _routing_lock:
+        _routing[key] += 1
+
+
+#pool settings for one engine, DB_REPLICA_POOL_SIZE etc. override DB_POOL_SIZE etc. for the replica
+def engine_options(url, replica=False):
+    if url.startswith('sqlite'):
+        return {}
+
+    def setting(key, default, cast):
+        value = environ.get(f'DB_REPLICA_{key}') if replica else None
+        return cast(value if value is not None else environ.get(f'DB_{key}', default))
+
+    return {
+        'pool_size': setting('POOL_SIZE', 10, int),
+        'max_overflow': setting('MAX_OVERFLOW', 10, int),
+        'pool_timeout': setting('POOL_TIMEOUT', 30, float),
+        'pool_recycle': setting('POOL_RECYCLE', 1800, int),
+        'pool_pre_ping': setting('POOL_PRE_PING', '1', str) != '0'
+    }
+
+
+#primary from DB_URL, optional read replica from DB_REPLICA_URL
+def configure_database(app):
+    url = environ.get('DB_URL')
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(url)
+    replica_url = environ.get('DB_REPLICA_URL')
+    if replica_url:
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA: dict(url=replica_url, **engine_options(replica_url, replica=True))}
+
+
+#sends the queries of read_only views to the replica, everything else to the model's engine
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context() and g.get('read_replica') and not self._flushing:
+            return self._db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+#whose writes a read has to see: the acting user, the user the route is about, or the client
+def reader_key():
+    return request.headers.get('X-User-Name') or (request.view_args or {}).get('username') or request.remote_addr
+
+
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if REPLICA in current_app.config.get('SQLALCHEMY_BINDS', {}):
+            if request.headers.get('X-Read-Consistency') == 'primary':
+                _count('primary')
+            elif recent_writers.get(reader_key(), False):
+                _count('sticky')
+            else:
+                g.read_replica = True
+                _count('replica')
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def register_database(app, db):
+    @app.after_request
+    def remember_writer(response):
+        if request.method not in ('GET', 'HEAD', 'OPTIONS') and not g.get('read_replica') and response.status_code < 400:
+            recent_writers.set(reader_key(), True)
+        return response
+
+    def database_stats():
+        engines = {bind or 'primary': engine for bind, engine in db.engines.items()}
+        with _routing_lock:
+            routing = dict(_routing)
+        return make_response(jsonify({
+            'pools': {name: engine.pool.status() for name, engine in engines.items()},
+            'read_routing': routing,
+            'sticky_seconds': REPLICA_STICKY_SECONDS
+        }), 200)
+    app.add_url_rule('/manage/db', 'database_stats', database_stats, methods=['GET'])
@@ -0,0 +1,29 @@
+from datetime import datetime
+from os import environ
+from common.serialization import ndjson_response, csv_response
+
+
+EXPORT_YIELD_PER = int(environ.get('EXPORT_YIELD_PER', 2000))
+EXPORT_FORMATS = {'ndjson': ndjson_response, 'csv': csv_response}
+
+
+#stream a whole table in id order from a server-side cursor; ?after_id= and ?since= give incremental pulls
+def export_response(args, query, serializer, id_column, since_column):
+    export_format = args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+
+    query = query.with_entities(*serializer.columns)
+    after_id = args.get('after_id')
+    if after_id:
+        query = query.filter(id_column > int(after_id))
+    since = args.get('since')
+    if since:
+        query = query.filter(since_column > datetime.fromisoformat(since))
+    query = query.order_by(id_column)
+    limit = args.get('limit')
+    if limit:
+        query = query.limit(int(limit))
+
+    # yield_per streams from a server-side cursor on Postgres, so memory does not grow with the table
+    return EXPORT_FORMATS[export_format](query.yield_per(EXPORT_YIELD_PER), serializer)
@@ -0,0 +1,109 @@
+from flask import make_response
+from datetime import datetime, timedelta
+from os import environ
+import hashlib
+import json
+import threading
+from common.cache import create_cache, MISSING
+
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 64
+
+
+class InvalidIdempotencyKeyError(ValueError):
+    pass
+
+
+#the key was already used for a request with a different body
+class IdempotencyConflictError(ValueError):
+    pass
+
+
+#response stored per Idempotency-Key, written in the same transaction as the change it answers for
+def idempotency_model(db):
+    class IdempotencyRecord(db.Model):
+        __tablename__ = 'idempotency_key'
+
+        key = db.Column(db.String(IDEMPOTENCY_KEY_MAX_LENGTH), primary_key=True)
+        fingerprint = db.Column(db.String(64), nullable=False)
+        status_code = db.Column(db.Integer, nullable=False)
+        body = db.Column(db.Text, nullable=False)
+        created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+        expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    return IdempotencyRecord
+
+
+def request_key(request):
+    key = request.headers.get('Idempotency-Key')
+    if key is not None and not 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise InvalidIdempotencyKeyError(f'Idempotency-Key must be 1 to {IDEMPOTENCY_KEY_MAX_LENGTH} characters')
+    return key
+
+
+def request_fingerprint(request):
+    digest = hashlib.sha256()
+    digest.update(f'{request.method} {request.path}\n'.encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+#keyed store of replayable responses: a table, with recently used keys in memory
+class IdempotencyStore:
+    def __init__(self, db, model):
+        self.db = db
+        self.model = model
+        self.ttl = float(environ.get('IDEMPOTENCY_TTL', 86400))
+        self.purge_every = int(environ.get('IDEMPOTENCY_PURGE_EVERY', 1000))
+        self.cache = create_cache(
+            'idempotency',
+            int(environ.get('IDEMPOTENCY_CACHE_SIZE', 10000)),
+            min(self.ttl, float(environ.get('IDEMPOTENCY_CACHE_TTL', 600)))
+        )
+        self._saves = 0
+        self._lock = threading.Lock()
+
+    #the stored (status_code, body) for key, or None if the key is new or expired
+    def lookup(self, key, fingerprint):
+        entry = self.cache.get(key)
+        if entry is MISSING:
+            record = self.db.session.get(self.model, key)
+            if record is None or record.expires_at <= datetime.utcnow():
+                return None
+            entry = (record.fingerprint, record.status_code, record.body)
+            self.cache.set(key, entry)
+
+        stored_fingerprint, status_code, body = entry
+        if stored_fingerprint != fingerprint:
+            raise IdempotencyConflictError('Idempotency-Key was already used with a different request')
+        return status_code, body
+
+    #add the response to the session, the caller commits it with its own change
+    def save(self, key, fingerprint, status_code, body):
+        now = datetime.utcnow()
+        # merge, so an expired record under the same key is overwritten
+        self.db.session.merge(self.model(
+            key=key,
+            fingerprint=fingerprint,
+            status_code=status_code,
+            body=json.dumps(body),
+            created_at=now,
+            expires_at=now + timedelta(seconds=self.ttl)
+        ))
+        with self._lock:
+            self._saves += 1
+            purge = self.purge_every > 0 and self._saves % self.purge_every == 0
+        if purge:
+            self.model.query.filter(self.model.expires_at <= now).delete(synchronize_session=False)
+
+    #cache a committed response, so repeats skip the table
+    def remember(self, key, fingerprint, status_code, body):
+        self.cache.set(key, (fingerprint, status_code, json.dumps(body)))
+
+    @staticmethod
+    def replay(stored):
+        status_code, body = stored
+        response = make_response(body, status_code)
+        response.mimetype = 'application/json'
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
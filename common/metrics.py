@@ -0,0 +1,204 @@
+from flask import g, request, has_request_context, make_response
+from sqlalchemy import event
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+import time
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+
+    def inc(self, labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{_labels(labels)} {_number(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, labels, value):
+        series = self.values.get(labels)
+        if series is None:
+            # one slot per bucket plus +Inf, then the sum
+            series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for labels, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(labels, ("le", _number(bound)))} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(labels)} {_number(series[-1])}')
+            lines.append(f'{self.name}_count{_labels(labels)} {cumulative}')
+        return lines
+
+
+#process-wide metrics, rendered in the Prometheus text format
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def counter(self, name, help_text):
+        return self._metrics.setdefault(name, Counter(name, help_text))
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self._metrics.setdefault(name, Histogram(name, help_text, buckets))
+
+    def inc(self, metric, labels, amount=1):
+        with self._lock:
+            metric.inc(labels, amount)
+
+    def observe(self, metric, labels, value):
+        with self._lock:
+            metric.observe(labels, value)
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for metric in self._metrics.values():
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+http_requests = REGISTRY.counter('http_requests_total', 'Handled requests by route, method and status code.')
+http_latency = REGISTRY.histogram('http_request_duration_seconds', 'Request handling time by route and method.')
+request_queries = REGISTRY.histogram(
+    'http_request_db_queries', 'SQL statements executed per request, by route.', QUERY_COUNT_BUCKETS
+)
+request_db_time = REGISTRY.histogram('http_request_db_seconds', 'Time spent in SQL per request, by route.')
+db_latency = REGISTRY.histogram('db_query_duration_seconds', 'Duration of single SQL statements.')
+outbound_latency = REGISTRY.histogram(
+    'http_client_request_duration_seconds', 'Calls to sibling services by target, method and status.'
+)
+
+
+# SQL counts of a request timed by request_timer, where Flask's g is not available
+_request_counts = ContextVar('metrics_request_counts', default=None)
+
+
+#record one call to a sibling service, status is the HTTP code or 'error'
+def observe_outbound(target, method, status, seconds):
+    REGISTRY.observe(outbound_latency, (('target', target), ('method', method), ('status', status)), seconds)
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _instrument_engine(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        REGISTRY.observe(db_latency, (), elapsed)
+        if has_request_context() and 'metrics_started' in g:
+            g.metrics_queries += 1
+            g.metrics_db_seconds += elapsed
+        else:
+            counts = _request_counts.get()
+            if counts is not None:
+                counts['queries'] += 1
+                counts['db_seconds'] += elapsed
+
+
+def observe_request(route, method, status, seconds, queries, db_seconds):
+    labels = (('route', route), ('method', method))
+    REGISTRY.inc(http_requests, labels + (('status', status),))
+    REGISTRY.observe(http_latency, labels, seconds)
+    REGISTRY.observe(request_queries, (('route', route),), queries)
+    REGISTRY.observe(request_db_time, (('route', route),), db_seconds)
+
+
+#the request metrics of register_metrics for routes served without Flask; the caller sets counts['status']
+@contextmanager
+def request_timer(route, method):
+    counts = {'status': 500, 'queries': 0, 'db_seconds': 0.0}
+    token = _request_counts.set(counts)
+    started = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        _request_counts.reset(token)
+        observe_request(route, method, counts['status'], time.perf_counter() - started, counts['queries'], counts['db_seconds'])
+
+
+#per-route latency, status, SQL and outbound timings, served on /metrics
+def register_metrics(app, db=None):
+    if db is not None:
+        with app.app_context():
+            for engine in db.engines.values():
+                _instrument_engine(engine)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_db_seconds = 0.0
+
+    @app.after_request
+    def record_request(response):
+        _record(response.status_code)
+        return response
+
+    @app.teardown_request
+    def record_failure(exc):
+        # after_request is skipped when a view raises
+        if exc is not None:
+            _record(500)
+
+    def _record(status):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        observe_request(_route(), request.method, status, time.perf_counter() - started, g.metrics_queries, g.metrics_db_seconds)
+
+    def metrics():
+        response = make_response(REGISTRY.render(), 200)
+        response.mimetype = 'text/plain'
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return response
+    app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
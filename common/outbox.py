@@ -0,0 +1,266 @@
+from flask import jsonify, make_response
+from datetime import datetime, timedelta
+from os import environ
+from sqlalchemy import func
+import json
+import logging
+import threading
+import time
+import uuid
+import requests
+from common.service_client import service_client, ServiceUnavailableError
+from common.tracing import start_span, current_traceparent, parse_traceparent
+
+
+PENDING = 'PENDING'
+SENT = 'SENT'
+FAILED = 'FAILED'
+
+
+#outbox table for a service's db, written in the same transaction as the change it announces
+def outbox_model(db):
+    class OutboxEvent(db.Model):
+        __tablename__ = 'outbox'
+
+        id = db.Column(db.Integer, primary_key=True)
+        event_key = db.Column(db.String(36), unique=True, nullable=False, default=lambda: str(uuid.uuid4()))
+        target = db.Column(db.String(40), nullable=False)
+        method = db.Column(db.String(10), nullable=False)
+        path = db.Column(db.String(255), nullable=False)
+        payload = db.Column(db.Text, nullable=True)
+        status = db.Column(db.String(10), nullable=False, default=PENDING)
+        attempts = db.Column(db.Integer, nullable=False, default=0)
+        last_error = db.Column(db.Text, nullable=True)
+        created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+        next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+        sent_at = db.Column(db.DateTime, nullable=True)
+        # trace of the request that wrote the event, delivery is recorded in the same trace
+        traceparent = db.Column(db.String(55), nullable=True)
+
+        __table_args__ = (
+            db.Index('ix_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+        )
+
+    return OutboxEvent
+
+
+#delivers pending outbox events to sibling services in batches
+class OutboxDispatcher:
+    def __init__(self, app, db, model, on_delivered=None):
+        self.app = app
+        self.db = db
+        self.model = model
+        self.on_delivered = on_delivered
+        self.batch_size = int(environ.get('OUTBOX_BATCH_SIZE', 100))
+        self.poll_interval = float(environ.get('OUTBOX_POLL_INTERVAL', 1.0))
+        self.max_attempts = int(environ.get('OUTBOX_MAX_ATTEMPTS', 10))
+        self.backoff = float(environ.get('OUTBOX_BACKOFF', 0.5))
+        self.max_backoff = float(environ.get('OUTBOX_MAX_BACKOFF', 60))
+        # claimed events are hidden from other workers this long, a crashed worker's claims run out after it
+        self.claim_timeout = float(environ.get('OUTBOX_CLAIM_TIMEOUT', 300))
+        # sent and failed events are kept this long, then purged every OUTBOX_PURGE_INTERVAL seconds
+        self.retention = float(environ.get('OUTBOX_RETENTION', 7 * 86400))
+        self.purge_interval = float(environ.get('OUTBOX_PURGE_INTERVAL', 600))
+
+        self.started_at = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+        self.last_batch_ms = None
+        self.purged = 0
+        self._last_purge = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    #add an event to the session (the request's by default), the caller commits it with its own change
+    def enqueue(self, target, method, path, payload=None, session=None):
+        event = self.model(
+            target=target,
+            method=method,
+            path=path,
+            payload=json.dumps(payload) if payload is not None else None,
+            traceparent=current_traceparent()
+        )
+        (session or self.db.session).add(event)
+        return event
+
+    def wake(self):
+        self._wake.set()
+
+    def start(self):
+        if self._thread is None:
+            self.started_at = time.monotonic()
+            self._thread = threading.Thread(target=self.run_forever, name='outbox-dispatcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            if self._last_purge is None or time.monotonic() - self._last_purge >= self.purge_interval:
+                self._last_purge = time.monotonic()
+                try:
+                    self.purge()
+                except Exception as e:
+                    logging.error(f"Outbox purge failed: {e}")
+            try:
+                delivered = self.dispatch_batch()
+            except Exception as e:
+                logging.error(f"Outbox dispatch failed: {e}")
+                delivered = 0
+            if delivered < self.batch_size:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    #lock a batch of due events just long enough to push their next attempt past the claim timeout
+    def _claim(self, session):
+        query = (
+            self.model.query
+            .filter(self.model.status == PENDING, self.model.next_attempt_at <= datetime.utcnow())
+            .order_by(self.model.id)
+            .limit(self.batch_size)
+        )
+        if self.db.engine.dialect.name == 'postgresql':
+            # several workers can share the table without sending an event twice
+            query = query.with_for_update(skip_locked=True)
+        events = query.all()
+        claimed_until = datetime.utcnow() + timedelta(seconds=self.claim_timeout)
+        for event in events:
+            event.next_attempt_at = claimed_until
+        session.commit()
+        return events
+
+    #no transaction is open while a target is called, each outcome is committed on its own
+    def dispatch_batch(self):
+        with self.app.app_context():
+            session = self.db.session
+            session().expire_on_commit = False
+            try:
+                events = self._claim(session)
+                if not events:
+                    return 0
+
+                started = time.perf_counter()
+                # target -> when its failed event is retried; its later events wait as long, without an attempt
+                unavailable = {}
+                for event in events:
+                    if event.target in unavailable:
+                        event.next_attempt_at = unavailable[event.target]
+                    else:
+                        self._deliver(event)
+                        if event.status == PENDING:
+                            unavailable[event.target] = event.next_attempt_at
+                    session.commit()
+                with self._lock:
+                    self.batches += 1
+                    self.last_batch_ms = round((time.perf_counter() - started) * 1000, 3)
+                return len(events)
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.remove()
+
+    #drop sent and failed events older than the retention
+    def purge(self):
+        with self.app.app_context():
+            try:
+                cutoff = datetime.utcnow() - timedelta(seconds=self.retention)
+                purged = self.model.query.filter(
+                    self.model.status.in_((SENT, FAILED)), self.model.next_attempt_at < cutoff
+                ).delete(synchronize_session=False)
+                self.db.session.commit()
+            except Exception:
+                self.db.session.rollback()
+                raise
+            finally:
+                self.db.session.remove()
+        with self._lock:
+            self.purged += purged
+        return purged
+
+    def _deliver(self, event):
+        with start_span(f'outbox {event.target}', parent=parse_traceparent(event.traceparent), event_key=event.event_key):
+            self._send(event)
+
+    def _send(self, event):
+        client = service_client(event.target)
+        payload = json.loads(event.payload) if event.payload else None
+        event.attempts += 1
+        try:
+            response = client.request(event.method, event.path, json=payload, headers={'Idempotency-Key': event.event_key})
+        except (ServiceUnavailableError, requests.RequestException) as e:
+            self._retry(event, str(e))
+            return
+
+        if response.status_code < 400:
+            event.status = SENT
+            event.sent_at = event.next_attempt_at = datetime.utcnow()
+            event.last_error = None
+            with self._lock:
+                self.sent += 1
+            if self.on_delivered:
+                try:
+                    self.on_delivered(event, response)
+                except Exception as e:
+                    logging.error(f"Outbox callback failed for event {event.event_key}: {e}")
+        elif response.status_code < 500 and response.status_code != 429:
+            # the target rejected the event, retrying cannot help
+            self._fail(event, f'HTTP {response.status_code}: {response.text[:500]}')
+        else:
+            self._retry(event, f'HTTP {response.status_code}')
+
+    def _retry(self, event, error):
+        event.last_error = error
+        if event.attempts >= self.max_attempts:
+            self._fail(event, error)
+            return
+        delay = min(self.backoff * (2 ** (event.attempts - 1)), self.max_backoff)
+        event.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+        with self._lock:
+            self.retried += 1
+
+    def _fail(self, event, error):
+        event.status = FAILED
+        event.last_error = error
+        # purge() ages finished events by next_attempt_at, which still holds the claim
+        event.next_attempt_at = datetime.utcnow()
+        with self._lock:
+            self.failed += 1
+        logging.error(f"Outbox event {event.event_key} to {event.target} failed: {error}")
+
+    def stats(self):
+        pending, oldest = self.db.session.query(
+            func.count(self.model.id), func.min(self.model.created_at)
+        ).filter(self.model.status == PENDING).one()
+        with self._lock:
+            uptime = time.monotonic() - self.started_at if self.started_at else None
+            return {
+                'pending': pending,
+                'lag_seconds': round((datetime.utcnow() - oldest).total_seconds(), 3) if oldest else 0,
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'batches': self.batches,
+                'purged': self.purged,
+                'last_batch_ms': self.last_batch_ms,
+                'sent_per_second': round(self.sent / uptime, 3) if uptime else None,
+                'running': self._thread is not None and self._thread.is_alive()
+            }
+
+
+def register_outbox_stats_route(app, dispatcher):
+    def outbox_stats():
+        return make_response(jsonify(dispatcher.stats()), 200)
+    app.add_url_rule('/manage/outbox', 'outbox_stats', outbox_stats, methods=['GET'])
+
+
+#start the dispatcher thread unless OUTBOX_DISPATCHER=0 (e.g. when a separate worker runs it)
+def start_dispatcher(dispatcher):
+    if environ.get('OUTBOX_DISPATCHER', '1') != '0':
+        dispatcher.start()
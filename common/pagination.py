@@ -0,0 +1,60 @@
+from os import environ
+from sqlalchemy import tuple_
+import base64
+import json
+
+
+MAX_PER_PAGE = int(environ.get('MAX_PER_PAGE', 100))
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidCursorError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidCursorError('Invalid cursor')
+    return values
+
+
+#per_page from the query string, capped at MAX_PER_PAGE
+def page_size(args, default=10):
+    per_page = args.get('per_page', default, type=int)
+    return max(1, min(per_page, MAX_PER_PAGE))
+
+
+def flag(args, name, default):
+    value = args.get(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes')
+
+
+#one page ordered by columns (the last one must be unique), continuing after cursor
+def keyset_page(query, columns, cursor, per_page, descending=False):
+    if cursor:
+        values = decode_cursor(cursor, len(columns))
+        if len(columns) == 1:
+            key, after = columns[0], values[0]
+        else:
+            key, after = tuple_(*columns), tuple_(*values)
+        query = query.filter(key < after if descending else key > after)
+
+    order = [column.desc() for column in columns] if descending else list(columns)
+    items = query.order_by(*order).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        next_cursor = encode_cursor([getattr(items[-1], column.key) for column in columns])
+    return items, next_cursor
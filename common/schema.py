@@ -0,0 +1,46 @@
+from sqlalchemy import UniqueConstraint, inspect, text
+import logging
+
+
+#bring a table created by an older version up to its model; create_all only creates tables that are missing
+#columns maps each added column to the value existing rows get (None leaves them NULL)
+def upgrade_table(db, model, columns=None, ddl=()):
+    table = model.__table__
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        if not inspector.has_table(table.name):
+            return
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for name, backfill in (columns or {}).items():
+            if name in existing:
+                continue
+            column = table.c[name]
+            logging.warning(f"Adding column {table.name}.{name}")
+            conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {name} {column.type.compile(conn.dialect)}'))
+            if backfill is not None:
+                conn.execute(text(f'UPDATE {table.name} SET {name} = :value'), {'value': backfill})
+                # SQLite cannot add NOT NULL to an existing column, the model still enforces it there
+                if not column.nullable and conn.dialect.name == 'postgresql':
+                    conn.execute(text(f'ALTER TABLE {table.name} ALTER COLUMN {name} SET NOT NULL'))
+
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+        # the DDL the table runs after create, e.g. dialect specific indexes; it has to be idempotent
+        for statement in ddl:
+            statement(table, conn)
+
+        unique = {tuple(constraint['column_names']) for constraint in inspector.get_unique_constraints(table.name)}
+        unique |= {tuple(index['column_names']) for index in inspector.get_indexes(table.name) if index['unique']}
+        missing = [
+            tuple(constraint.columns.keys()) for constraint in table.constraints
+            if isinstance(constraint, UniqueConstraint) and tuple(constraint.columns.keys()) not in unique
+        ]
+
+    # one transaction each, duplicate rows must not keep the service from starting
+    for column_names in missing:
+        name = f"uq_{table.name}_{'_'.join(column_names)}"
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS {name} ON {table.name} ({', '.join(column_names)})"))
+        except Exception as e:
+            logging.error(f"Could not add unique index {name}, remove the duplicates and restart: {e}")
@@ -0,0 +1,127 @@
+from flask import Response, stream_with_context
+from flask.json.provider import JSONProvider
+from decimal import Decimal
+from os import environ
+import csv
+import io
+import orjson
+
+
+NDJSON_CHUNK_BYTES = int(environ.get('NDJSON_CHUNK_BYTES', 65536))
+NDJSON_YIELD_PER = int(environ.get('NDJSON_YIELD_PER', 1000))
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonlines')
+
+_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def dumps(obj):
+    return orjson.dumps(obj, default=_default, option=_OPTIONS)
+
+
+#jsonify and request.get_json through orjson
+class FastJSONProvider(JSONProvider):
+    mimetype = 'application/json'
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
+
+
+def register_json_provider(app):
+    app.json = FastJSONProvider(app)
+
+
+def iso_date(value):
+    return value.strftime('%Y-%m-%d')
+
+
+def iso_datetime(value):
+    return value.isoformat()
+
+
+#turns result rows of a fixed column list into dicts, optionally with a joined model nested under a key
+class RowSerializer:
+    def __init__(self, fields, nested=None):
+        self.keys = tuple(field[0] for field in fields)
+        self.attributes = tuple(field[1].key for field in fields)
+        self.converters = tuple((i, field[2]) for i, field in enumerate(fields) if len(field) > 2)
+        self.nested = nested
+        self.width = len(fields)
+        self.columns = [field[1] for field in fields] + (nested[1].columns if nested else [])
+
+    def _fields(self, values):
+        if self.converters:
+            values = list(values)
+            for i, convert in self.converters:
+                if values[i] is not None:
+                    values[i] = convert(values[i])
+        return dict(zip(self.keys, values))
+
+    def __call__(self, row):
+        if not self.nested:
+            return self._fields(row)
+        body = self._fields(row[:self.width])
+        key, serializer = self.nested
+        nested = row[self.width:]
+        body[key] = serializer(nested) if nested[0] is not None else None
+        return body
+
+    #the same dict from a model instance, without the nested model
+    def from_object(self, obj):
+        return self._fields([getattr(obj, attribute) for attribute in self.attributes])
+
+
+def wants_ndjson(request):
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best_match(('application/json',) + NDJSON_MIMETYPES) in NDJSON_MIMETYPES
+
+
+#stream rows as one JSON document per line, in chunks, without building the whole body
+def ndjson_response(rows, serialize, status=200):
+    def generate():
+        chunk = []
+        size = 0
+        for row in rows:
+            line = orjson.dumps(serialize(row), default=_default, option=_OPTIONS | orjson.OPT_APPEND_NEWLINE)
+            chunk.append(line)
+            size += len(line)
+            if size >= NDJSON_CHUNK_BYTES:
+                yield b''.join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield b''.join(chunk)
+
+    return Response(stream_with_context(generate()), status, mimetype='application/x-ndjson')
+
+
+#stream rows as CSV with a header line, in chunks
+def csv_response(rows, serialize, status=200):
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(serialize.keys)
+        for row in rows:
+            writer.writerow(serialize(row).values())
+            if buffer.tell() >= NDJSON_CHUNK_BYTES:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(stream_with_context(generate()), status, mimetype='text/csv')
@@ -0,0 +1,253 @@
+from os import environ
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from common.metrics import observe_outbound
+from common.tracing import start_span
+# the registry lives apart so services without outbound calls do not need requests
+from common.clients import _clients, _clients_lock, register_client, client_stats, register_client_stats_route
+
+
+DEFAULT_SERVICE_URLS = {
+    'loyalty': 'http://loyalty_service:8050',
+    'payment': 'http://payment_service:8060',
+    'reservation': 'http://reservation_service:8070',
+}
+
+
+#a 503 with Retry-After is the target's admission control turning work away, not a sign it is down
+def is_load_shed(response):
+    return response.status_code == 503 and 'Retry-After' in response.headers
+
+
+#urllib3 retries that leave shed requests to the caller; retrying at once only adds to the load
+class ShedAwareRetry(Retry):
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 503 and has_retry_after:
+            return False
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class ServiceUnavailableError(Exception):
+    pass
+
+
+#simple consecutive-failure circuit breaker
+class CircuitBreaker:
+    CLOSED = 'CLOSED'
+    OPEN = 'OPEN'
+    HALF_OPEN = 'HALF_OPEN'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                # let a single probe through, everything else waits for its result
+                self.state = self.HALF_OPEN
+                return True
+            if self.state == self.HALF_OPEN:
+                self.rejected += 1
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    #a call that ended without saying anything about the target's health; a probe slot is handed back
+    def release_probe(self):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                # opened_at is already past reset_timeout, so the next call probes again
+                self.state = self.OPEN
+
+    def stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout': self.reset_timeout,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected
+            }
+
+
+#keep-alive client for one sibling service
+class ServiceClient:
+    def __init__(self, name, base_url, pool_size=10, connect_timeout=1.0, read_timeout=5.0,
+                 retries=2, backoff=0.1, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        # connect errors are retried for every method (nothing was sent yet),
+        # read errors and 502/503/504 only for idempotent ones; DELETE is not among them,
+        # a replayed delete answers differently (404) from the one that went through
+        retry = ShedAwareRetry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD', 'PUT', 'OPTIONS']),
+            raise_on_status=False
+        )
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False, max_retries=retry)
+        self.session = requests.Session()
+        # sibling services are reached directly; reading proxy settings from the
+        # environment on every call costs milliseconds
+        self.session.trust_env = False
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    #one client span per call, its id travels to the target as the parent of the target's span
+    def request(self, method, path, **kwargs):
+        with start_span(f'{method} {self.name}', 'client', target=self.name, path=path) as span:
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, traceparent=span.traceparent())
+            response = self._send(method, path, **kwargs)
+            span.attributes['status'] = response.status_code
+            return response
+
+    def _send(self, method, path, **kwargs):
+        if not self.breaker.allow_request():
+            raise ServiceUnavailableError(f'{self.name} service is unavailable (circuit open)')
+
+        kwargs.setdefault('timeout', self.timeout)
+        with self._lock:
+            self.requests += 1
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, f'{self.base_url}{path}', **kwargs)
+        except requests.RequestException:
+            observe_outbound(self.name, method, 'error', time.perf_counter() - started)
+            with self._lock:
+                self.errors += 1
+            self.breaker.record_failure()
+            raise
+        except Exception:
+            # failed before reaching the target, e.g. an unserializable body
+            self.breaker.release_probe()
+            raise
+        observe_outbound(self.name, method, response.status_code, time.perf_counter() - started)
+
+        if response.status_code >= 500 and not is_load_shed(response):
+            with self._lock:
+                self.errors += 1
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request('PATCH', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def pool_stats(self):
+        pools = []
+        manager = self.adapter.poolmanager
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            pools.append({
+                'host': pool.host,
+                'port': pool.port,
+                'maxsize': self.pool_size,
+                # the queue is pre-filled with None placeholders for unopened slots
+                'idle_connections': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests
+            })
+        return pools
+
+    def stats(self):
+        with self._lock:
+            counters = {'requests': self.requests, 'errors': self.errors}
+        return {
+            'base_url': self.base_url,
+            'connect_timeout': self.timeout[0],
+            'read_timeout': self.timeout[1],
+            'counters': counters,
+            'pools': self.pool_stats(),
+            'circuit_breaker': self.breaker.stats()
+        }
+
+
+#scheme, host and port of a target from <NAME>_SERVICE_BASE_URL; the client adds the full path
+#<NAME>_SERVICE_URL is not read any more, LOYALTY_SERVICE_URL used to end in /loyalty
+def service_url(name):
+    legacy = environ.get(f'{name.upper()}_SERVICE_URL')
+    url = environ.get(f'{name.upper()}_SERVICE_BASE_URL')
+    if legacy and not url:
+        logging.warning(
+            f"{name.upper()}_SERVICE_URL is ignored, set {name.upper()}_SERVICE_BASE_URL to the service's "
+            f"base URL without a path (using {DEFAULT_SERVICE_URLS.get(name, '')})"
+        )
+    return url or DEFAULT_SERVICE_URLS.get(name, '')
+
+
+#per-target setting, e.g. LOYALTY_HTTP_READ_TIMEOUT, falling back to HTTP_READ_TIMEOUT
+def _setting(name, key, default, cast):
+    value = environ.get(f'{name.upper()}_{key}', environ.get(key))
+    return cast(value) if value is not None else default
+
+
+def service_client(name):
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None:
+            client = ServiceClient(
+                name,
+                service_url(name),
+                pool_size=_setting(name, 'HTTP_POOL_SIZE', 10, int),
+                connect_timeout=_setting(name, 'HTTP_CONNECT_TIMEOUT', 1.0, float),
+                read_timeout=_setting(name, 'HTTP_READ_TIMEOUT', 5.0, float),
+                retries=_setting(name, 'HTTP_RETRIES', 2, int),
+                backoff=_setting(name, 'HTTP_BACKOFF', 0.1, float),
+                failure_threshold=_setting(name, 'HTTP_BREAKER_THRESHOLD', 5, int),
+                reset_timeout=_setting(name, 'HTTP_BREAKER_RESET', 30.0, float)
+            )
+            _clients[name] = client
+        return client
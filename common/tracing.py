@@ -0,0 +1,215 @@
+from flask import g, request, jsonify, make_response
+from sqlalchemy import event
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import environ
+import json
+import logging
+import random
+import secrets
+import threading
+import time
+
+
+TRACE_SAMPLE_RATE = float(environ.get('TRACE_SAMPLE_RATE', 1.0))
+TRACE_BUFFER_SIZE = int(environ.get('TRACE_BUFFER_SIZE', 10000))
+TRACE_FILE = environ.get('TRACE_FILE')
+
+SpanContext = namedtuple('SpanContext', ['trace_id', 'span_id', 'sampled'])
+
+_current_span = ContextVar('current_span', default=None)
+
+
+#W3C traceparent header: 00-<trace id>-<parent span id>-<flags>
+def parse_traceparent(header):
+    if not header:
+        return None
+    parts = header.strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        sampled = bool(int(parts[3], 16) & 1)
+    except ValueError:
+        return None
+    return SpanContext(parts[1], parts[2], sampled)
+
+
+class Span:
+    def __init__(self, name, kind, parent=None, start=None, **attributes):
+        if parent is None:
+            self.trace_id = secrets.token_hex(16)
+            self.parent_id = None
+            self.sampled = random.random() < TRACE_SAMPLE_RATE
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            self.sampled = parent.sampled
+        self.span_id = secrets.token_hex(8)
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.start = time.time() if start is None else start
+        self.duration_ms = None
+
+    @property
+    def context(self):
+        return SpanContext(self.trace_id, self.span_id, self.sampled)
+
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def end(self, end=None):
+        self.duration_ms = round(((time.time() if end is None else end) - self.start) * 1000, 3)
+        collector.record(self)
+
+    def json(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'service': collector.service,
+            'name': self.name,
+            'kind': self.kind,
+            'start': self.start,
+            'duration_ms': self.duration_ms,
+            'attributes': self.attributes
+        }
+
+
+#keeps recent spans in memory and appends them to TRACE_FILE as JSON lines when set
+class SpanCollector:
+    def __init__(self, size, path=None):
+        self.service = environ.get('SERVICE_NAME', 'service')
+        self.spans = deque(maxlen=size)
+        self.path = path
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._file = None
+
+    def record(self, span):
+        if not span.sampled:
+            return
+        data = span.json()
+        with self._lock:
+            self.spans.append(data)
+            self.recorded += 1
+            if self.path:
+                try:
+                    if self._file is None:
+                        self._file = open(self.path, 'a', buffering=1)
+                    self._file.write(json.dumps(data) + '\n')
+                except OSError as e:
+                    logging.error(f"Could not write span to {self.path}: {e}")
+
+    def trace(self, trace_id):
+        with self._lock:
+            spans = [span for span in self.spans if span['trace_id'] == trace_id]
+        return sorted(spans, key=lambda span: span['start'])
+
+    #root span of each recent trace, newest first
+    def recent(self, limit=50):
+        with self._lock:
+            roots = [span for span in reversed(self.spans) if span['parent_id'] is None or span['kind'] == 'server']
+        traces = {}
+        for span in roots:
+            if span['trace_id'] not in traces:
+                traces[span['trace_id']] = span
+            if len(traces) >= limit:
+                break
+        return list(traces.values())
+
+
+collector = SpanCollector(TRACE_BUFFER_SIZE, TRACE_FILE)
+
+
+def current_span():
+    return _current_span.get()
+
+
+def current_traceparent():
+    span = _current_span.get()
+    return span.traceparent() if span is not None else None
+
+
+#run a block as a child of the current span (or of parent), starting a new trace if there is none
+@contextmanager
+def start_span(name, kind='internal', parent=None, **attributes):
+    if parent is None:
+        current = _current_span.get()
+        parent = current.context if current is not None else None
+    span = Span(name, kind, parent, **attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span.attributes['error'] = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end()
+
+
+def _instrument_engine(engine):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('span_started', []).append(time.time())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['span_started'].pop()
+        parent = _current_span.get()
+        if parent is None or not parent.sampled:
+            return
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'SQL'
+        Span(f'db {operation}', 'db', parent.context, start=started, statement=statement[:200]).end()
+
+
+#server span per request, joined to the caller's trace through the traceparent header
+def register_tracing(app, service, db=None):
+    collector.service = environ.get('SERVICE_NAME', service)
+    if db is not None:
+        with app.app_context():
+            for engine in db.engines.values():
+                _instrument_engine(engine)
+
+    @app.before_request
+    def start_request_span():
+        span = Span(
+            f'{request.method} {request.url_rule.rule if request.url_rule is not None else request.path}',
+            'server',
+            parse_traceparent(request.headers.get('traceparent'))
+        )
+        g.trace_span = span
+        g.trace_token = _current_span.set(span)
+
+    @app.after_request
+    def tag_response(response):
+        span = g.get('trace_span')
+        if span is not None:
+            span.attributes['status'] = response.status_code
+            response.headers['X-Trace-Id'] = span.trace_id
+        return response
+
+    @app.teardown_request
+    def end_request_span(exc):
+        span = g.pop('trace_span', None)
+        if span is None:
+            return
+        if exc is not None:
+            span.attributes['error'] = f'{type(exc).__name__}: {exc}'
+            span.attributes.setdefault('status', 500)
+        _current_span.reset(g.pop('trace_token'))
+        span.end()
+
+    def list_traces():
+        return make_response(jsonify({'traces': collector.recent(request.args.get('limit', 50, type=int))}), 200)
+    app.add_url_rule('/manage/traces', 'list_traces', list_traces, methods=['GET'])
+
+    def get_trace(trace_id):
+        spans = collector.trace(trace_id)
+        if not spans:
+            return make_response(jsonify({'message': 'Trace not found!'}), 404)
+        return make_response(jsonify({'trace_id': trace_id, 'spans': spans}), 200)
+    app.add_url_rule('/manage/traces/<trace_id>', 'get_trace', get_trace, methods=['GET'])
@@ -0,0 +1,196 @@
+from flask import Flask, request, jsonify, make_response
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from os import environ
+import logging
+import time
+import orjson
+import requests
+from common.service_client import service_client, register_client_stats_route, ServiceUnavailableError
+from common.metrics import register_metrics
+from common.tracing import register_tracing
+from common.batch import MAX_BATCH_SIZE
+from common.cache import create_cache, register_cache_stats_route, MISSING
+from common.serialization import register_json_provider
+
+
+app = Flask(__name__)
+register_json_provider(app)
+register_metrics(app)
+register_tracing(app, 'gateway')
+register_client_stats_route(app)
+register_cache_stats_route(app)
+
+reservation_client = service_client('reservation')
+loyalty_client = service_client('loyalty')
+payment_client = service_client('payment')
+
+# assembled profiles, dropped on booking or cancel through the gateway
+PROFILE_TTL = float(environ.get('GATEWAY_PROFILE_TTL', 5))
+profile_cache = create_cache('profiles', int(environ.get('GATEWAY_PROFILE_CACHE_SIZE', 10000)), PROFILE_TTL)
+# when each user's profile was last invalidated, so a fetch that started earlier is not cached
+invalidated_at = create_cache('profile-invalidations', int(environ.get('GATEWAY_PROFILE_CACHE_SIZE', 10000)), PROFILE_TTL * 2)
+
+fanout = ThreadPoolExecutor(max_workers=int(environ.get('GATEWAY_FANOUT_WORKERS', 32)), thread_name_prefix='fanout')
+
+
+class UpstreamError(Exception):
+    pass
+
+
+#run fn on the fan-out pool with the caller's trace context
+def submit(fn, *args):
+    return fanout.submit(copy_context().run, fn, *args)
+
+
+def user_headers(username):
+    return {'X-User-Name': username}
+
+
+#every reservation of the user in one streamed call instead of page by page
+def fetch_reservations(username):
+    response = reservation_client.get('/reservation', params={'format': 'ndjson'}, headers=user_headers(username))
+    if response.status_code != 200:
+        raise UpstreamError(f'reservation service returned {response.status_code}')
+    return [orjson.loads(line) for line in response.content.splitlines() if line]
+
+
+#None when the user has no loyalty record
+def fetch_loyalty(username):
+    response = loyalty_client.get(f'/loyalty/{username}', headers=user_headers(username))
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise UpstreamError(f'loyalty service returned {response.status_code}')
+    return response.json()
+
+
+#payments of all the reservations in as few batch calls as MAX_BATCH_SIZE allows, by reservation id
+def fetch_payments(username, reservation_ids):
+    payments = {}
+    for i in range(0, len(reservation_ids), MAX_BATCH_SIZE):
+        chunk = reservation_ids[i:i + MAX_BATCH_SIZE]
+        response = payment_client.post('/payments/batch', json={'reservation_ids': chunk}, headers=user_headers(username))
+        if response.status_code != 200:
+            raise UpstreamError(f'payment service returned {response.status_code}')
+        for reservation_id, found in response.json()['found'].items():
+            payments[int(reservation_id)] = found[-1]
+    return payments
+
+
+def hotel_info(hotel):
+    if hotel is None:
+        return None
+    return {
+        'hotelUid': hotel['hotel_uid'],
+        'name': hotel['name'],
+        'fullAddress': f"{hotel['country']}, {hotel['city']}, {hotel['address']}",
+        'stars': hotel['stars']
+    }
+
+
+def reservation_info(reservation, payment):
+    return {
+        'reservationUid': reservation['reservation_uid'],
+        'hotel': hotel_info(reservation['hotel_id']),
+        'startDate': reservation['start_date'],
+        'endDate': reservation['end_date'],
+        'status': reservation['status'],
+        'payment': {'status': payment['status'], 'price': payment['price']} if payment else {}
+    }
+
+
+#reservations and loyalty in parallel, then the payments in one batch; partial profiles are returned but not cached
+def load_profile(username):
+    reservations_future = submit(fetch_reservations, username)
+    loyalty_future = submit(fetch_loyalty, username)
+
+    # without reservations there is nothing to show
+    reservations = reservations_future.result()
+
+    # the loyalty call is still in flight while the payments are fetched
+    complete = True
+    try:
+        payments = fetch_payments(username, [reservation['id'] for reservation in reservations])
+    except (UpstreamError, ServiceUnavailableError, requests.RequestException) as e:
+        logging.error(f"Payments unavailable for {username}: {e}")
+        payments, complete = {}, False
+
+    try:
+        loyalty = loyalty_future.result()
+    except (UpstreamError, ServiceUnavailableError, requests.RequestException) as e:
+        logging.error(f"Loyalty unavailable for {username}: {e}")
+        loyalty, complete = None, False
+
+    profile = {
+        'reservations': [reservation_info(reservation, payments.get(reservation['id'])) for reservation in reservations],
+        'loyalty': {'status': loyalty['status'], 'discount': loyalty['discount']} if loyalty else None
+    }
+    return profile, complete
+
+
+def invalidate_profile(username):
+    invalidated_at.set(username, time.monotonic())
+    profile_cache.invalidate(username)
+
+
+@app.route('/test', methods=['GET'])
+def test():
+    return make_response(jsonify({'message': 'test route'}), 200)
+
+
+#full user info: reservations with hotel and payment, plus loyalty status
+@app.route('/api/v1/me', methods=['GET'])
+def get_user_info():
+    username = request.headers.get('X-User-Name')
+    if not username:
+        return make_response(jsonify({'message': 'X-User-Name header is required'}), 400)
+
+    profile = profile_cache.get(username)
+    if profile is not MISSING:
+        return make_response(jsonify(profile), 200)
+
+    started = time.monotonic()
+    try:
+        profile, complete = load_profile(username)
+    except (UpstreamError, ServiceUnavailableError, requests.RequestException) as e:
+        logging.error(f"Reservations unavailable for {username}: {e}")
+        return make_response(jsonify({'message': 'Reservation service unavailable'}), 503)
+
+    if complete and invalidated_at.get(username, 0) < started:
+        profile_cache.set(username, profile)
+    return make_response(jsonify(profile), 200)
+
+
+#book through the gateway, the cached profile is dropped once the booking went through
+@app.route('/api/v1/reservations', methods=['POST'])
+def create_reservation():
+    username = request.headers.get('X-User-Name')
+    if not username:
+        return make_response(jsonify({'message': 'X-User-Name header is required'}), 400)
+    try:
+        response = reservation_client.post('/reservation', json=request.get_json(silent=True), headers=user_headers(username))
+    except (ServiceUnavailableError, requests.RequestException):
+        return make_response(jsonify({'message': 'Reservation service unavailable'}), 503)
+    if response.status_code < 400:
+        invalidate_profile(username)
+    return make_response(response.content, response.status_code, {'Content-Type': response.headers.get('Content-Type', 'application/json')})
+
+
+#cancel through the gateway
+@app.route('/api/v1/reservations/<reservation_uid>', methods=['DELETE'])
+def cancel_reservation(reservation_uid):
+    username = request.headers.get('X-User-Name')
+    if not username:
+        return make_response(jsonify({'message': 'X-User-Name header is required'}), 400)
+    try:
+        response = reservation_client.delete(f'/reservations/{reservation_uid}', headers=user_headers(username))
+    except (ServiceUnavailableError, requests.RequestException):
+        return make_response(jsonify({'message': 'Reservation service unavailable'}), 503)
+    if response.status_code < 400:
+        invalidate_profile(username)
+    return make_response(response.content, response.status_code, {'Content-Type': response.headers.get('Content-Type', 'application/json')})
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=8080, debug=True)
@@ -1,12 +1,56 @@
 from flask import Flask, request, jsonify, make_response
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import and_, case, func, literal, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from collections import Counter
+from datetime import datetime, timedelta
 from os import environ
+import itertools
+import logging
+import threading
 import uuid
+from common.clients import register_client_stats_route
+from common.metrics import register_metrics
+from common.tracing import register_tracing
+from common.database import configure_database, RoutingSession, register_database, read_only
+from common.admission import register_admission, Limit
+from common.bulk import bulk_ingest
+from common.batch import batch_keys, keyed_response
+from common.serialization import RowSerializer, register_json_provider
+from common.cache import create_cache, register_cache_stats_route, MISSING
+from common.counters import upsert_increment
+from common.schema import upgrade_table
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = environ.get('DB_URL')
+register_json_provider(app)
+configure_database(app)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+register_metrics(app, db)
+register_tracing(app, 'loyalty', db)
+register_client_stats_route(app)
+register_database(app, db)
+register_admission(app, {
+    # the increments come from the reservation outbox, without X-User-Name, so only their concurrency is capped
+    'increment_loyalty_user': Limit(concurrency=8),
+    'create_loyalty_users_bulk': Limit(concurrency=2),
+    'replace_loyalty_tiers': Limit(concurrency=1),
+    'recompute_loyalty_tiers': Limit(concurrency=1)
+})
+register_cache_stats_route(app)
+
+# (min reservation_count, status, discount), highest tier first; seeds the loyalty_tier table
+LOYALTY_TIERS = [
+    (20, 'GOLD', 10),
+    (15, 'SILVER', 7),
+    (10, 'BRONZE', 5),
+]
+DEFAULT_TIER = ('UNDEFINED', 0)
+RECOMPUTE_CHUNK_SIZE = int(environ.get('LOYALTY_RECOMPUTE_CHUNK_SIZE', 5000))
+
+# other processes pick up tier table changes within this many seconds
+LOYALTY_TIERS_TTL = float(environ.get('LOYALTY_TIERS_TTL', 30))
+tier_cache = create_cache('loyalty-tiers', 1, LOYALTY_TIERS_TTL)
 
 class Loyalty(db.Model):
     __tablename__ = 'loyalty'
@@ -17,30 +61,160 @@ class Loyalty(db.Model):
     discount = db.Column(db.Integer, default=5, nullable=False)
 
     def json(self):
-        return {
-            'id': self.id,
-            'username': self.username,
-            'reservation_count': self.reservation_count,
-            'status': self.status,
-            'discount': self.discount
-        }
+        return LOYALTY_ROW.from_object(self)
 
     def update_status(self):
-        if self.reservation_count >= 20:
-            self.status = 'GOLD'
-            self.discount = 10
-        elif self.reservation_count >= 15:
-            self.status = 'SILVER'
-            self.discount = 7
-        elif self.reservation_count >= 10:
-            self.status = 'BRONZE'
-            self.discount = 5
-        else:
-            self.status = 'UNDEFINED'
-            self.discount = 0
+        for min_count, status, discount in current_tiers():
+            if self.reservation_count >= min_count:
+                self.status = status
+                self.discount = discount
+                return
+        self.status, self.discount = DEFAULT_TIER
+
+
+LOYALTY_ROW = RowSerializer([
+    ('id', Loyalty.id),
+    ('username', Loyalty.username),
+    ('reservation_count', Loyalty.reservation_count),
+    ('status', Loyalty.status),
+    ('discount', Loyalty.discount)
+])
+
+
+#tier thresholds shared by the per-row and the set-based recompute
+class LoyaltyTier(db.Model):
+    __tablename__ = 'loyalty_tier'
+    status = db.Column(db.String(80), primary_key=True)
+    min_count = db.Column(db.Integer, unique=True, nullable=False)
+    discount = db.Column(db.Integer, nullable=False)
+
+
+#users per status, adjusted by every write so the distribution is read without a scan
+class LoyaltyTierCount(db.Model):
+    __tablename__ = 'loyalty_tier_count'
+    status = db.Column(db.String(80), primary_key=True)
+    users = db.Column(db.Integer, nullable=False, default=0)
+
+
+#(min_count, status, discount) from the tier table, highest tier first
+def current_tiers():
+    tiers = tier_cache.get('tiers')
+    if tiers is MISSING:
+        rows = LoyaltyTier.query.order_by(LoyaltyTier.min_count.desc()).all()
+        tiers = [(tier.min_count, tier.status, tier.discount) for tier in rows]
+        tier_cache.set('tiers', tiers)
+    return tiers
+
+
+#SQL CASE expressions with the same tiers as Loyalty.update_status
+def tier_status_case(count, tiers=None):
+    tiers = current_tiers() if tiers is None else tiers
+    if not tiers:
+        return literal(DEFAULT_TIER[0])
+    return case(*[(count >= min_count, status) for min_count, status, _ in tiers], else_=DEFAULT_TIER[0])
+
+
+def tier_discount_case(count, tiers=None):
+    tiers = current_tiers() if tiers is None else tiers
+    if not tiers:
+        return literal(DEFAULT_TIER[1])
+    return case(*[(count >= min_count, discount) for min_count, _, discount in tiers], else_=DEFAULT_TIER[1])
+
+
+#apply {status: delta} to the tier counts, in the caller's transaction
+def adjust_tier_counts(changes):
+    for status, delta in changes.items():
+        if delta:
+            upsert_increment(db.session, LoyaltyTierCount.__table__, {'status': status}, {'users': delta})
+
+
+def rebuild_tier_counts():
+    LoyaltyTierCount.query.delete()
+    rows = db.session.query(Loyalty.status, func.count(Loyalty.id)).group_by(Loyalty.status).all()
+    db.session.bulk_insert_mappings(LoyaltyTierCount, [{'status': status, 'users': users} for status, users in rows])
+    db.session.commit()
+
+
+#set-based recompute of every user's tier, one id range per transaction
+def recompute_tiers(chunk_size=RECOMPUTE_CHUNK_SIZE):
+    tiers = current_tiers()
+    status_case = tier_status_case(Loyalty.reservation_count, tiers)
+    discount_case = tier_discount_case(Loyalty.reservation_count, tiers)
+    first_id, last_id = db.session.query(func.min(Loyalty.id), func.max(Loyalty.id)).one()
+    updated = 0
+    chunks = 0
+    if first_id is None:
+        return {'updated': updated, 'chunks': chunks}
+
+    for low in range(first_id, last_id + 1, chunk_size):
+        stale = and_(
+            Loyalty.id.between(low, low + chunk_size - 1),
+            or_(Loyalty.status != status_case, Loyalty.discount != discount_case)
+        )
+        # lock the rows that move and note where they move from, so the counts follow
+        moves = db.session.execute(select(Loyalty.status, status_case).where(stale).with_for_update()).all()
+        if moves:
+            changes = Counter()
+            for old_status, new_status in moves:
+                changes[old_status] -= 1
+                changes[new_status] += 1
+            result = db.session.execute(
+                update(Loyalty)
+                .where(stale)
+                .values(status=status_case, discount=discount_case)
+                .execution_options(synchronize_session=False)
+            )
+            adjust_tier_counts(changes)
+            updated += result.rowcount
+        db.session.commit()
+        chunks += 1
+    return {'updated': updated, 'chunks': chunks}
+
+
+#recompute again once every process has dropped its cached tiers, for rows they wrote with the old ones meanwhile
+def schedule_recompute(delay=LOYALTY_TIERS_TTL + 1):
+    def run():
+        with app.app_context():
+            try:
+                result = recompute_tiers()
+                logging.info(f"Delayed tier recompute moved {result['updated']} users")
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Delayed tier recompute failed: {e}")
+
+    timer = threading.Timer(delay, run)
+    timer.daemon = True
+    timer.start()
+    return delay
+
+#Idempotency-Key of every applied increment, so redelivered events are not counted twice
+class ProcessedEvent(db.Model):
+    __tablename__ = 'processed_event'
+    event_key = db.Column(db.String(64), primary_key=True)
+    processed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+# keys are kept well past the senders' retry window, then purged every PROCESSED_EVENT_PURGE_EVERY increments
+PROCESSED_EVENT_RETENTION = float(environ.get('PROCESSED_EVENT_RETENTION', 7 * 86400))
+PROCESSED_EVENT_PURGE_EVERY = int(environ.get('PROCESSED_EVENT_PURGE_EVERY', 1000))
+processed_events = itertools.count(1)
+
 
 with app.app_context():
     db.create_all()
+    upgrade_table(db, ProcessedEvent)
+    if LoyaltyTier.query.first() is None:
+        db.session.add_all([
+            LoyaltyTier(min_count=min_count, status=status, discount=discount)
+            for min_count, status, discount in LOYALTY_TIERS
+        ])
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another worker seeded it first
+            db.session.rollback()
+    if LoyaltyTierCount.query.first() is None and Loyalty.query.first() is not None:
+        rebuild_tier_counts()
 
 
 
@@ -68,17 +242,68 @@ def create_loyalty_user():
     )
 
     db.session.add(user)
+    adjust_tier_counts({status: 1})
     db.session.commit()
 
     return make_response(jsonify({'message': f'User {username} created successfully'}), 201)
 
+def validate_bulk_user(data):
+    missing = [key for key in ['username', 'reservation_count', 'status', 'discount'] if data.get(key) is None]
+    if missing:
+        return None, f'Missing fields: {missing}'
+    for key in ['reservation_count', 'discount']:
+        if not isinstance(data[key], int) or isinstance(data[key], bool):
+            return None, f'{key} must be an integer'
+    return {
+        'username': data['username'],
+        'reservation_count': data['reservation_count'],
+        'status': data['status'],
+        'discount': data['discount']
+    }, None
+
+
+def existing_usernames(usernames):
+    rows = db.session.query(Loyalty.username).filter(Loyalty.username.in_(usernames)).all()
+    return {row.username for row in rows}
+
+
+#bulk create users from a JSON array or NDJSON body, committed in chunks
+@app.route('/loyalty/bulk', methods=['POST'])
+def create_loyalty_users_bulk():
+    try:
+        report = bulk_ingest(
+            request, db.session, Loyalty.__table__, 'username', validate_bulk_user, existing_usernames,
+            on_insert=lambda rows: adjust_tier_counts(Counter(row['status'] for row in rows))
+        )
+        return make_response(jsonify(report.json()), 200 if report.inserted or not report.error_count else 400)
+    except ValueError as e:
+        return make_response(jsonify({'message': str(e)}), 400)
+    except Exception as e:
+        return make_response(jsonify({'message': f'Error creating users: {str(e)}'}), 500)
+
 #get user info
 @app.route('/loyalty/<username>', methods=['GET'])
+@read_only
 def get_loyalty_user_by_username(username):
-    user = Loyalty.query.filter_by(username=username).first()
+    user = Loyalty.query.with_entities(*LOYALTY_ROW.columns).filter(Loyalty.username == username).first()
     if not user:
         return make_response(jsonify({'message': f'User {username} not found'}), 404)
-    return make_response(jsonify(user.json()), 200)
+    return make_response(jsonify(LOYALTY_ROW(user)), 200)
+
+
+#get many users by usernames
+@app.route('/loyalty/batch', methods=['POST'])
+@read_only
+def get_loyalty_users_batch():
+    try:
+        keys = batch_keys(request.get_json(silent=True), 'usernames')
+        users = Loyalty.query.with_entities(*LOYALTY_ROW.columns).filter(Loyalty.username.in_(keys)).all()
+        found = {user.username: LOYALTY_ROW(user) for user in users}
+        return make_response(jsonify(keyed_response(keys, found)), 200)
+    except ValueError as e:
+        return make_response(jsonify({'message': str(e)}), 400)
+    except Exception as e:
+        return make_response(jsonify({'message': f'Error fetching users: {str(e)}'}), 500)
 
 
 #update user
@@ -93,13 +318,132 @@ def update_loyalty_user(username):
         return make_response(jsonify({'message': f'User {username} not found'}), 404)
 
     try:
+        old_status = user.status
         user.reservation_count = data['reservation_count']
         user.update_status()
+        adjust_tier_counts({old_status: -1, user.status: 1} if user.status != old_status else {})
         db.session.commit()
         return make_response(jsonify({'message': f'User {username} updated successfully'}), 200)
 
     except Exception as e:
         return make_response(jsonify({'message': f'Error updating user: {str(e)}'}), 500)
 
+
+#atomically add a delta to reservation_count and recompute the tier
+@app.route('/loyalty/<username>/increment', methods=['POST'])
+def increment_loyalty_user(username):
+    data = request.get_json(silent=True) or {}
+    delta = data.get('delta', 1)
+    if not isinstance(delta, int) or isinstance(delta, bool):
+        return make_response(jsonify({'message': 'delta must be an integer'}), 400)
+
+    try:
+        event_key = request.headers.get('Idempotency-Key')
+        if event_key:
+            db.session.add(ProcessedEvent(event_key=event_key))
+            try:
+                db.session.flush()
+            except IntegrityError:
+                # already applied, answer with the current row
+                db.session.rollback()
+                user = Loyalty.query.filter_by(username=username).first()
+                if not user:
+                    return make_response(jsonify({'message': f'User {username} not found'}), 404)
+                return make_response(jsonify(user.json()), 200)
+            if PROCESSED_EVENT_PURGE_EVERY > 0 and next(processed_events) % PROCESSED_EVENT_PURGE_EVERY == 0:
+                cutoff = datetime.utcnow() - timedelta(seconds=PROCESSED_EVENT_RETENTION)
+                ProcessedEvent.query.filter(ProcessedEvent.processed_at < cutoff).delete(synchronize_session=False)
+
+        # lock the row first, the old status is needed to keep the tier counts right
+        old_status = db.session.execute(
+            select(Loyalty.status).where(Loyalty.username == username).with_for_update()
+        ).scalar()
+        if old_status is None:
+            db.session.rollback()
+            return make_response(jsonify({'message': f'User {username} not found'}), 404)
+
+        # SET expressions see the old row, so the tier is derived from the same new count
+        new_count = case((Loyalty.reservation_count + delta < 0, 0), else_=Loyalty.reservation_count + delta)
+        stmt = (
+            update(Loyalty)
+            .where(Loyalty.username == username)
+            .values(
+                reservation_count=new_count,
+                status=tier_status_case(new_count),
+                discount=tier_discount_case(new_count)
+            )
+            .returning(*LOYALTY_ROW.columns)
+            .execution_options(synchronize_session=False)
+        )
+        row = db.session.execute(stmt).first()
+        if row.status != old_status:
+            adjust_tier_counts({old_status: -1, row.status: 1})
+        db.session.commit()
+        return make_response(jsonify(LOYALTY_ROW(row)), 200)
+
+    except Exception as e:
+        db.session.rollback()
+        return make_response(jsonify({'message': f'Error updating user: {str(e)}'}), 500)
+
+
+#tiers with their thresholds and the number of users in each, from the maintained counts
+@app.route('/loyalty-tiers', methods=['GET'])
+@read_only
+def get_loyalty_tiers():
+    counts = {row.status: row.users for row in LoyaltyTierCount.query.all()}
+    tiers = [
+        {'status': status, 'min_count': min_count, 'discount': discount, 'users': counts.pop(status, 0)}
+        for min_count, status, discount in current_tiers()
+    ]
+    tiers.append({'status': DEFAULT_TIER[0], 'min_count': 0, 'discount': DEFAULT_TIER[1], 'users': counts.pop(DEFAULT_TIER[0], 0)})
+    return make_response(jsonify({
+        'tiers': tiers,
+        # statuses set by hand that match no tier
+        'other': {status: users for status, users in counts.items() if users},
+        'total': sum(tier['users'] for tier in tiers) + sum(counts.values())
+    }), 200)
+
+
+#replace the tier thresholds and move every user to their new tier, again once the other processes' caches ran out
+@app.route('/loyalty-tiers', methods=['PUT'])
+def replace_loyalty_tiers():
+    data = request.get_json(silent=True) or {}
+    tiers = data.get('tiers')
+    if not isinstance(tiers, list) or not tiers:
+        return make_response(jsonify({'message': 'tiers must be a non-empty list'}), 400)
+    for tier in tiers:
+        if not isinstance(tier, dict) or not isinstance(tier.get('status'), str) or \
+                not all(isinstance(tier.get(key), int) and not isinstance(tier.get(key), bool) for key in ('min_count', 'discount')):
+            return make_response(jsonify({'message': 'Each tier needs status, integer min_count and integer discount'}), 400)
+    if len({tier['status'] for tier in tiers}) != len(tiers) or len({tier['min_count'] for tier in tiers}) != len(tiers):
+        return make_response(jsonify({'message': 'Tier statuses and min_counts must be unique'}), 400)
+
+    try:
+        LoyaltyTier.query.delete()
+        db.session.add_all([
+            LoyaltyTier(status=tier['status'], min_count=tier['min_count'], discount=tier['discount']) for tier in tiers
+        ])
+        db.session.commit()
+        tier_cache.clear()
+        result = recompute_tiers()
+        result['recheck_in'] = schedule_recompute()
+        return make_response(jsonify(result), 200)
+    except Exception as e:
+        db.session.rollback()
+        return make_response(jsonify({'message': f'Error updating tiers: {str(e)}'}), 500)
+
+
+#re-derive every user's tier from the tier table
+@app.route('/loyalty-tiers/recompute', methods=['POST'])
+def recompute_loyalty_tiers():
+    try:
+        chunk_size = request.args.get('chunk_size', RECOMPUTE_CHUNK_SIZE, type=int)
+        if chunk_size <= 0:
+            return make_response(jsonify({'message': 'chunk_size must be positive'}), 400)
+        return make_response(jsonify(recompute_tiers(chunk_size)), 200)
+    except Exception as e:
+        db.session.rollback()
+        return make_response(jsonify({'message': f'Error recomputing tiers: {str(e)}'}), 500)
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8050, debug=True)
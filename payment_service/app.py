@@ -2,43 +2,266 @@ from flask import Flask, request, jsonify, make_response
 from flask_sqlalchemy import SQLAlchemy
 from os import environ
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
+import logging
+import threading
+import time
+import orjson
 import requests
-
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from common.service_client import service_client, register_client_stats_route, ServiceUnavailableError
+from common.metrics import register_metrics
+from common.tracing import register_tracing
+from common.database import configure_database, RoutingSession, register_database, read_only
+from common.admission import register_admission, Limit
+from common.pagination import keyset_page, page_size, flag, InvalidCursorError
+from common.batch import batch_keys, keyed_response
+from common.outbox import outbox_model, OutboxDispatcher, register_outbox_stats_route, start_dispatcher
+from common.idempotency import idempotency_model, IdempotencyStore, IdempotencyConflictError, request_key, request_fingerprint
+from common.cache import register_cache_stats_route
+from common.counters import upsert_increment, upsert_newer
+from common.serialization import RowSerializer, register_json_provider, iso_datetime, wants_ndjson, ndjson_response, NDJSON_YIELD_PER
+from common.export import export_response
+from common.schema import upgrade_table
 
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = environ.get('DB_URL')
+register_json_provider(app)
+configure_database(app)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+register_metrics(app, db)
+register_tracing(app, 'payment', db)
+register_client_stats_route(app)
+register_database(app, db)
+register_admission(app, {
+    # payment writes and listing scans are throttled, point reads stay unlimited
+    'create_payment': Limit(concurrency=8, rate=2, burst=5),
+    'get_all_payments': Limit(concurrency=4, rate=5, burst=10),
+    'get_payments_report': Limit(concurrency=4),
+    'export_payments': Limit(concurrency=2),
+    'export_deleted_payments': Limit(concurrency=2),
+    'rebuild_rollups': Limit(concurrency=1)
+})
+
+reservation_client = service_client('reservation')
 
-from flask_sqlalchemy import SQLAlchemy
-import uuid
-
-db = SQLAlchemy()
 
 class Payment(db.Model):
     __tablename__ = 'payment'
 
     id = db.Column(db.Integer, primary_key=True)
     payment_uid = db.Column(db.String(36), unique=True, nullable=False, default=lambda: str(uuid.uuid4()))
-    reservation_id = db.Column(db.Integer, nullable=False)
+    # one payment per reservation
+    reservation_id = db.Column(db.Integer, nullable=False, unique=True)
     status = db.Column(db.String(20), nullable=False, default='PAID')
     price = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
 
     def json(self):
-        return {
-            'id': self.id,
-            'payment_uid': self.payment_uid,
-            'reservation_id': self.reservation_id,
-            'status': self.status,
-            'price': self.price
-        }
+        return PAYMENT_ROW.from_object(self)
+
+
+PAYMENT_ROW = RowSerializer([
+    ('id', Payment.id),
+    ('payment_uid', Payment.payment_uid),
+    ('reservation_id', Payment.reservation_id),
+    ('status', Payment.status),
+    ('price', Payment.price)
+])
+# flat rows for analytics exports
+PAYMENT_EXPORT_ROW = RowSerializer([
+    ('id', Payment.id),
+    ('payment_uid', Payment.payment_uid),
+    ('reservation_id', Payment.reservation_id),
+    ('status', Payment.status),
+    ('price', Payment.price),
+    ('created_at', Payment.created_at, iso_datetime)
+])
+
+
+#payments are deleted for good, the tombstone tells incremental export readers to drop their copy
+class PaymentTombstone(db.Model):
+    __tablename__ = 'payment_tombstone'
+
+    id = db.Column(db.Integer, primary_key=True)
+    payment_id = db.Column(db.Integer, nullable=False)
+    payment_uid = db.Column(db.String(36), nullable=False)
+    reservation_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+
+PAYMENT_TOMBSTONE_ROW = RowSerializer([
+    ('id', PaymentTombstone.id),
+    ('payment_id', PaymentTombstone.payment_id),
+    ('payment_uid', PaymentTombstone.payment_uid),
+    ('reservation_id', PaymentTombstone.reservation_id),
+    ('deleted_at', PaymentTombstone.deleted_at, iso_datetime)
+])
 
 
+#payment counts and revenue per time bucket and status, kept current on every create and delete
+class PaymentRollup(db.Model):
+    __tablename__ = 'payment_rollup'
+
+    granularity = db.Column(db.String(5), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    status = db.Column(db.String(20), primary_key=True)
+    payments = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+ROLLUP_GRANULARITIES = {
+    'hour': lambda t: t.replace(minute=0, second=0, microsecond=0),
+    'day': lambda t: t.replace(hour=0, minute=0, second=0, microsecond=0)
+}
+
+
+#count a payment in (sign=1) or out of (sign=-1) its buckets, in the caller's transaction
+def rollup_payment(payment, sign):
+    if payment.created_at is None:
+        return
+    for granularity, truncate in ROLLUP_GRANULARITIES.items():
+        upsert_increment(
+            db.session,
+            PaymentRollup.__table__,
+            {'granularity': granularity, 'bucket': truncate(payment.created_at), 'status': payment.status},
+            {'payments': sign, 'revenue': sign * payment.price}
+        )
+
+
+#recompute every bucket from the payment table, for data written before the rollups existed
+def rebuild_payment_rollups():
+    buckets = {}
+    rows = db.session.query(Payment.created_at, Payment.status, Payment.price).filter(Payment.created_at.isnot(None))
+    for created_at, status, price in rows.yield_per(1000):
+        for granularity, truncate in ROLLUP_GRANULARITIES.items():
+            counts = buckets.setdefault((granularity, truncate(created_at), status), [0, 0])
+            counts[0] += 1
+            counts[1] += price
+
+    PaymentRollup.query.delete()
+    db.session.bulk_insert_mappings(PaymentRollup, [
+        {'granularity': granularity, 'bucket': bucket, 'status': status, 'payments': payments, 'revenue': revenue}
+        for (granularity, bucket, status), (payments, revenue) in buckets.items()
+    ])
+    db.session.commit()
+    return len(buckets)
+
+
+#local copy of reservation statuses, fed by reservation events and a catch-up pull
+class ReservationStatus(db.Model):
+    __tablename__ = 'reservation_status'
+
+    reservation_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    reservation_uid = db.Column(db.String(36), nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    # the reservation's updated_at, an older event never overwrites a newer one
+    updated_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+RESERVATION_SYNC_PAGE = int(environ.get('RESERVATION_SYNC_PAGE', 5000))
+# the startup pull re-reads changes this far back from the newest one it has, for late commits
+RESERVATION_SYNC_OVERLAP = float(environ.get('RESERVATION_SYNC_OVERLAP', 60))
+RESERVATION_SYNC_RETRY = float(environ.get('RESERVATION_SYNC_RETRY', 5))
+reservation_sync = {'events': 0, 'stale_events': 0, 'pulled': 0, 'pulls': 0, 'last_pull_at': None}
+reservation_sync_lock = threading.Lock()
+
+
+def count_sync(**deltas):
+    with reservation_sync_lock:
+        for key, delta in deltas.items():
+            reservation_sync[key] += delta
+
+
+#apply one reservation row (export format) in the caller's transaction, False when a newer one is stored
+def apply_reservation_status(row):
+    return upsert_newer(
+        db.session,
+        ReservationStatus.__table__,
+        {'reservation_id': int(row['id'])},
+        {'reservation_uid': row['reservation_uid'], 'status': row['status'], 'updated_at': datetime.fromisoformat(row['updated_at'])},
+        'updated_at'
+    )
+
+
+#page through the reservation export from after_id on, optionally only rows changed since a time; limit stops after one page
+def pull_reservation_statuses(after_id=0, since=None, limit=None):
+    pulled = 0
+    page = limit or RESERVATION_SYNC_PAGE
+    while True:
+        params = {'format': 'ndjson', 'after_id': after_id, 'limit': page}
+        if since is not None:
+            params['since'] = since.isoformat()
+        # a lagging replica would hide the reservation the caller is asking about
+        response = reservation_client.get('/reservations/export', params=params, headers={'X-Read-Consistency': 'primary'})
+        if response.status_code != 200:
+            raise ServiceUnavailableError(f'Reservation export returned {response.status_code}')
+        rows = [orjson.loads(line) for line in response.content.splitlines() if line]
+        for row in rows:
+            apply_reservation_status(row)
+        db.session.commit()
+        pulled += len(rows)
+        if limit is not None or len(rows) < page:
+            break
+        after_id = rows[-1]['id']
+
+    count_sync(pulled=pulled, pulls=1)
+    with reservation_sync_lock:
+        reservation_sync['last_pull_at'] = datetime.utcnow().isoformat()
+    return pulled
+
+
+#everything the copy missed while this service was down, retried until the reservation service answers
+def catch_up_reservation_statuses():
+    while True:
+        with app.app_context():
+            try:
+                latest = db.session.query(func.max(ReservationStatus.updated_at)).scalar()
+                since = latest - timedelta(seconds=RESERVATION_SYNC_OVERLAP) if latest else None
+                pulled = pull_reservation_statuses(since=since)
+                logging.info(f"Reservation status catch-up pulled {pulled} reservations")
+                return
+            except Exception as e:
+                db.session.rollback()
+                logging.error(f"Reservation status catch-up failed: {e}")
+            finally:
+                db.session.remove()
+        time.sleep(RESERVATION_SYNC_RETRY)
+
+
+#the local status of a reservation; one this copy has not seen yet is pulled on its own, below the newest id too
+#(a lower id can commit after a higher one, or its event can still be on its way)
+def reservation_status(reservation_id):
+    reservation = db.session.get(ReservationStatus, reservation_id)
+    if reservation is None:
+        pull_reservation_statuses(reservation_id - 1, limit=1)
+        reservation = db.session.get(ReservationStatus, reservation_id)
+    return reservation
+
+
+OutboxEvent = outbox_model(db)
+IdempotencyRecord = idempotency_model(db)
+
 
 with app.app_context():
     db.create_all()
+    # payment tables from before created_at and the one-payment-per-reservation constraint
+    upgrade_table(db, Payment, {'created_at': datetime.utcnow()})
+    if PaymentRollup.query.first() is None and Payment.query.first() is not None:
+        rebuild_payment_rollups()
+
+outbox = OutboxDispatcher(app, db, OutboxEvent)
+register_outbox_stats_route(app, outbox)
+start_dispatcher(outbox)
+
+# RESERVATION_SYNC=0 skips the startup pull, e.g. for a worker next to a running service
+if environ.get('RESERVATION_SYNC', '1') != '0':
+    threading.Thread(target=catch_up_reservation_statuses, name='reservation-sync', daemon=True).start()
+
+idempotency = IdempotencyStore(db, IdempotencyRecord)
+register_cache_stats_route(app)
 
 #create a test route
 @app.route('/test', methods = ['GET'])
@@ -54,13 +277,23 @@ def create_payment():
         if not data or 'reservation_id' not in data or 'price' not in data:
             return make_response(jsonify({'message': 'Reservation ID and price are required!'}), 400)
 
-        reservation_service_url = "http://reservation_service:8070/reservations"
-        response = requests.get(f"{reservation_service_url}/{data['reservation_id']}")
-        if response.status_code == 404:
+        # a retried request gets the original response back
+        key = request_key(request)
+        if key:
+            fingerprint = request_fingerprint(request)
+            stored = idempotency.lookup(key, fingerprint)
+            if stored:
+                return idempotency.replay(stored)
+
+        existing = Payment.query.filter_by(reservation_id=data['reservation_id']).first()
+        if existing:
+            return payment_exists(existing)
+
+        reservation = reservation_status(int(data['reservation_id']))
+        if reservation is None:
             return make_response(jsonify({'message': 'Reservation not found!'}), 404)
 
-        reservation = response.json()
-        payment_status = 'PAID' if reservation['status'] == 'PAID' else 'PENDING'
+        payment_status = 'PAID' if reservation.status == 'PAID' else 'PENDING'
 
         payment = Payment(
             reservation_id=data['reservation_id'],
@@ -68,85 +301,226 @@ def create_payment():
             status=payment_status
         )
         db.session.add(payment)
-        db.session.commit()
-
-        return make_response(jsonify({'message': 'Payment created successfully!', 'payment_uid': payment.payment_uid}), 201)
+        try:
+            db.session.flush()
+            rollup_payment(payment, 1)
+            body = {'message': 'Payment created successfully!', 'payment_uid': payment.payment_uid}
+            if key:
+                idempotency.save(key, fingerprint, 201, body)
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent request with the same key or reservation got there first
+            db.session.rollback()
+            stored = idempotency.lookup(key, fingerprint) if key else None
+            if stored:
+                return idempotency.replay(stored)
+            existing = Payment.query.filter_by(reservation_id=data['reservation_id']).first()
+            if existing:
+                return payment_exists(existing)
+            raise
+        if key:
+            idempotency.remember(key, fingerprint, 201, body)
+
+        return make_response(jsonify(body), 201)
+    except IdempotencyConflictError as e:
+        return make_response(jsonify({'message': str(e)}), 422)
+    except ValueError as e:
+        return make_response(jsonify({'message': str(e)}), 400)
+    except (ServiceUnavailableError, requests.RequestException) as e:
+        return make_response(jsonify({'message': f'Reservation service unavailable: {str(e)}'}), 503)
     except Exception as e:
+        db.session.rollback()
         return make_response(jsonify({'message': f'Error creating payment: {str(e)}'}), 500)
 
 
-    
+def payment_exists(payment):
+    return make_response(jsonify({
+        'message': 'Payment already exists for this reservation!',
+        'payment_uid': payment.payment_uid
+    }), 409)
+
+
+#status change pushed by the reservation service's outbox
+@app.route('/reservation-status/<int:reservation_id>', methods=['PUT'])
+def put_reservation_status(reservation_id):
+    try:
+        data = request.get_json(silent=True)
+        if not data or data.get('id') != reservation_id or not all(field in data for field in ('reservation_uid', 'status', 'updated_at')):
+            return make_response(jsonify({'message': 'id, reservation_uid, status and updated_at are required!'}), 400)
+        applied = apply_reservation_status(data)
+        db.session.commit()
+        count_sync(events=1, stale_events=0 if applied else 1)
+        return make_response(jsonify({'message': 'Reservation status applied!' if applied else 'Newer status already stored'}), 200)
+    except ValueError as e:
+        db.session.rollback()
+        return make_response(jsonify({'message': str(e)}), 400)
+    except Exception as e:
+        db.session.rollback()
+        return make_response(jsonify({'message': f'Error applying reservation status: {str(e)}'}), 500)
+
+
+#size and freshness of the local reservation status copy
+@app.route('/manage/reservation-status', methods=['GET'])
+def reservation_status_stats():
+    reservations, last_id, last_updated = db.session.query(
+        func.count(ReservationStatus.reservation_id), func.max(ReservationStatus.reservation_id), func.max(ReservationStatus.updated_at)
+    ).one()
+    with reservation_sync_lock:
+        counters = dict(reservation_sync)
+    return make_response(jsonify(dict(
+        counters,
+        reservations=reservations,
+        last_id=last_id,
+        last_updated_at=last_updated.isoformat() if last_updated else None
+    )), 200)
+
+
 #get payment by uid
 @app.route('/payment/<payment_uid>', methods=['GET'])
+@read_only
 def get_payment(payment_uid):
     try:
-        payment = Payment.query.filter_by(payment_uid=payment_uid).first()
+        payment = Payment.query.with_entities(*PAYMENT_ROW.columns).filter(Payment.payment_uid == payment_uid).first()
         if not payment:
             return make_response(jsonify({'message': 'Payment not found!'}), 404)
-        
-        return make_response(jsonify({
-            'id': payment.id,
-            'payment_uid': payment.payment_uid,
-            'reservation_id': payment.reservation_id,
-            'status': payment.status,
-            'price': payment.price
-        }), 200)
+
+        return make_response(jsonify(PAYMENT_ROW(payment)), 200)
     except Exception as e:
         return make_response(jsonify({'message': f'Error fetching payment: {str(e)}'}), 500)
+
+
+#get many payments by payment_uids, or all payments of many reservation_ids
+@app.route('/payments/batch', methods=['POST'])
+@read_only
+def get_payments_batch():
+    try:
+        data = request.get_json(silent=True) or {}
+        if 'reservation_ids' in data:
+            keys = batch_keys(data, 'reservation_ids', int)
+            found = {}
+            for payment in Payment.query.filter(Payment.reservation_id.in_(keys)).order_by(Payment.id).all():
+                found.setdefault(payment.reservation_id, []).append(payment.json())
+            return make_response(jsonify(keyed_response(keys, found)), 200)
+
+        keys = batch_keys(data, 'payment_uids')
+        found = {payment.payment_uid: payment.json() for payment in Payment.query.filter(Payment.payment_uid.in_(keys)).all()}
+        return make_response(jsonify(keyed_response(keys, found)), 200)
+    except ValueError as e:
+        return make_response(jsonify({'message': str(e)}), 400)
+    except Exception as e:
+        return make_response(jsonify({'message': f'Error fetching payments: {str(e)}'}), 500)
     
 
-#update payment status
-@app.route('/payment', methods=['POST'])
-def create_payment():
+#get all payments
+@app.route('/payments', methods=['GET'])
+@read_only
+def get_all_payments():
     try:
-        data = request.get_json()
-        if not data or 'reservation_id' not in data or 'price' not in data:
-            return make_response(jsonify({'message': 'Reservation ID and price are required!'}), 400)
+        per_page = page_size(request.args)
+        query = Payment.query.with_entities(*PAYMENT_ROW.columns)
 
-        reservation_service_url = "http://reservation_service:8070/reservations"
-        response = requests.get(f"{reservation_service_url}/{data['reservation_id']}")
-        if response.status_code == 404:
-            return make_response(jsonify({'message': 'Reservation not found!'}), 404)
+        # NDJSON mode streams every payment instead of one page
+        if wants_ndjson(request):
+            return ndjson_response(query.order_by(Payment.id).yield_per(NDJSON_YIELD_PER), PAYMENT_ROW)
 
-        reservation = response.json()
-        payment_status = 'PAID' if reservation['status'] == 'PAID' else 'PENDING'
+        # keyset mode, ?cursor= (empty) starts from the first page
+        if 'cursor' in request.args:
+            payments, next_cursor = keyset_page(query, [Payment.id], request.args['cursor'], per_page)
+            body = {'payments': [PAYMENT_ROW(payment) for payment in payments], 'next_cursor': next_cursor}
+            if flag(request.args, 'include_total', False):
+                body['total'] = Payment.query.count()
+            return make_response(jsonify(body), 200)
 
-        payment = Payment(
-            reservation_id=data['reservation_id'],
-            price=data['price'],
-            status=payment_status
-        )
-        db.session.add(payment)
-        db.session.commit()
+        page = request.args.get('page', 1, type=int)
+        include_total = flag(request.args, 'include_total', True)
+        payments = query.order_by(Payment.id).paginate(page=page, per_page=per_page, error_out=False, count=include_total)
+
+        body = {'payments': [PAYMENT_ROW(payment) for payment in payments.items]}
+        if include_total:
+            body['total'] = payments.total
+        return make_response(jsonify(body), 200)
+    except InvalidCursorError as e:
+        return make_response(jsonify({'message': str(e)}), 400)
+    except Exception as e:
+        return make_response(jsonify({'message': f'Error fetching payments: {str(e)}'}), 500)
 
-        return make_response(jsonify({'message': 'Payment created successfully!', 'payment_uid': payment.payment_uid}), 201)
+#stream all payments as NDJSON or CSV, ?after_id= / ?since= (created_at) for incremental pulls
+#deleted payments are not in it any more, /payments/export/deleted lists them
+@app.route('/payments/export', methods=['GET'])
+@read_only
+def export_payments():
+    try:
+        return export_response(request.args, Payment.query, PAYMENT_EXPORT_ROW, Payment.id, Payment.created_at)
+    except ValueError as e:
+        return make_response(jsonify({'message': f'Invalid query parameters: {str(e)}'}), 400)
     except Exception as e:
-        return make_response(jsonify({'message': f'Error creating payment: {str(e)}'}), 500)
+        return make_response(jsonify({'message': f'Error exporting payments: {str(e)}'}), 500)
 
 
+#stream the deleted payments the same way, ?after_id= / ?since= (deleted_at)
+@app.route('/payments/export/deleted', methods=['GET'])
+@read_only
+def export_deleted_payments():
+    try:
+        return export_response(request.args, PaymentTombstone.query, PAYMENT_TOMBSTONE_ROW, PaymentTombstone.id, PaymentTombstone.deleted_at)
+    except ValueError as e:
+        return make_response(jsonify({'message': f'Invalid query parameters: {str(e)}'}), 400)
+    except Exception as e:
+        return make_response(jsonify({'message': f'Error exporting deleted payments: {str(e)}'}), 500)
 
 
-#get all payments
-@app.route('/payments', methods=['GET'])
-def get_all_payments():
+#payment counts and revenue by status and time bucket, read from the rollups
+@app.route('/payments/report', methods=['GET'])
+@read_only
+def get_payments_report():
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
-        payments = Payment.query.paginate(page=page, per_page=per_page, error_out=False)
+        granularity = request.args.get('granularity', 'day')
+        if granularity not in ROLLUP_GRANULARITIES:
+            raise ValueError(f"granularity must be one of {', '.join(ROLLUP_GRANULARITIES)}")
+
+        query = PaymentRollup.query.filter(PaymentRollup.granularity == granularity, PaymentRollup.payments != 0)
+        date_from = request.args.get('from')
+        if date_from:
+            query = query.filter(PaymentRollup.bucket >= datetime.fromisoformat(date_from))
+        date_to = request.args.get('to')
+        if date_to:
+            query = query.filter(PaymentRollup.bucket < datetime.fromisoformat(date_to))
+        status = request.args.get('status')
+        if status:
+            query = query.filter(PaymentRollup.status == status)
+
+        totals = {'payments': 0, 'revenue': 0}
+        by_status = {}
+        buckets = {}
+        for row in query.order_by(PaymentRollup.bucket, PaymentRollup.status).all():
+            bucket = buckets.setdefault(row.bucket, {'bucket': row.bucket.isoformat(), 'payments': 0, 'revenue': 0, 'by_status': {}})
+            bucket['by_status'][row.status] = {'payments': row.payments, 'revenue': row.revenue}
+            for counts in (totals, bucket, by_status.setdefault(row.status, {'payments': 0, 'revenue': 0})):
+                counts['payments'] += row.payments
+                counts['revenue'] += row.revenue
 
         return make_response(jsonify({
-            'payments': [
-                {
-                    'id': payment.id,
-                    'payment_uid': payment.payment_uid,
-                    'reservation_id': payment.reservation_id,
-                    'status': payment.status,
-                    'price': payment.price
-                } for payment in payments.items
-            ]
+            'granularity': granularity,
+            'totals': totals,
+            'by_status': by_status,
+            'buckets': list(buckets.values())
         }), 200)
+    except ValueError as e:
+        return make_response(jsonify({'message': f'Invalid query parameters: {str(e)}'}), 400)
     except Exception as e:
-        return make_response(jsonify({'message': f'Error fetching payments: {str(e)}'}), 500)
+        return make_response(jsonify({'message': f'Error building payments report: {str(e)}'}), 500)
+
+
+#recompute the rollups from the payment table
+@app.route('/manage/payment-rollups/rebuild', methods=['POST'])
+def rebuild_rollups():
+    try:
+        buckets = rebuild_payment_rollups()
+        return make_response(jsonify({'message': 'Payment rollups rebuilt!', 'buckets': buckets}), 200)
+    except Exception as e:
+        db.session.rollback()
+        return make_response(jsonify({'message': f'Error rebuilding payment rollups: {str(e)}'}), 500)
+
 
 #DELETE payment by uid
 @app.route('/payment/<payment_uid>', methods=['DELETE'])
@@ -160,16 +534,19 @@ def delete_payment(payment_uid):
         if not username:
             return make_response(jsonify({'message': 'X-User-Name header is required'}), 400)
 
-        # Notify loyalty service
-        loyalty_service_url = "http://loyalty_service:8050/loyalty"
+        # Notify loyalty service through the outbox, committed together with the delete
         if payment.status == 'PAID':
-            requests.patch(f"{loyalty_service_url}/{username}/", json={"reservation_count": -1})
+            outbox.enqueue('loyalty', 'POST', f"/loyalty/{username}/increment", {"delta": -1})
 
+        rollup_payment(payment, -1)
+        db.session.add(PaymentTombstone(payment_id=payment.id, payment_uid=payment.payment_uid, reservation_id=payment.reservation_id))
         db.session.delete(payment)
         db.session.commit()
+        outbox.wake()
 
         return make_response(jsonify({'message': 'Payment deleted successfully!'}), 200)
     except Exception as e:
+        db.session.rollback()
         return make_response(jsonify({'message': f'Error deleting payment: {str(e)}'}), 500)
 
 
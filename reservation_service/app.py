@@ -1,16 +1,64 @@
 from flask import Flask, request, jsonify, make_response
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, and_, event, func, or_, select
 from os import environ
 import uuid
 from datetime import datetime
 import requests
 import logging
+from common.service_client import service_client, register_client_stats_route, ServiceUnavailableError
+from common.metrics import register_metrics
+from common.tracing import register_tracing
+from common.database import configure_database, RoutingSession, register_database, read_only
+from common.admission import register_admission, Limit
+from common.cache import create_cache, register_cache_stats_route, MISSING
+from common.pagination import keyset_page, page_size, flag, InvalidCursorError
+from common.bulk import bulk_ingest
+from common.batch import batch_keys, keyed_response
+from common.outbox import outbox_model, OutboxDispatcher, register_outbox_stats_route, start_dispatcher
+from common.serialization import RowSerializer, register_json_provider, iso_date, iso_datetime, wants_ndjson, ndjson_response, NDJSON_YIELD_PER
+from common.export import export_response
+from common.schema import upgrade_table
 
 
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = environ.get('DB_URL')
+register_json_provider(app)
+configure_database(app)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+register_metrics(app, db)
+register_tracing(app, 'reservation', db)
+register_client_stats_route(app)
+register_database(app, db)
+admission = register_admission(app, {
+    # bookings and scans hold a pool connection the longest; point reads like get_hotel stay unlimited
+    'create_reservation': Limit(concurrency=8, rate=2, burst=5),
+    'cancel_reservation': Limit(concurrency=8, rate=2, burst=5),
+    'get_user_reservations': Limit(concurrency=16, rate=10, burst=20),
+    'get_available_hotels': Limit(concurrency=8),
+    'export_reservations': Limit(concurrency=2),
+    'create_hotels_bulk': Limit(concurrency=2)
+})
+register_cache_stats_route(app)
+
+loyalty_client = service_client('loyalty')
+
+loyalty_cache = create_cache(
+    'loyalty',
+    maxsize=int(environ.get('LOYALTY_CACHE_SIZE', 10000)),
+    ttl=float(environ.get('LOYALTY_CACHE_TTL', 60))
+)
+# unknown users are cached as None for this long; 0 disables negative caching
+LOYALTY_CACHE_NEGATIVE_TTL = float(environ.get('LOYALTY_CACHE_NEGATIVE_TTL', 0))
+
+# hotel rows as json, keyed by ('id', id) and ('uid', hotel_uid)
+hotel_cache = create_cache(
+    'hotel',
+    maxsize=int(environ.get('HOTEL_CACHE_SIZE', 10000)),
+    ttl=float(environ.get('HOTEL_CACHE_TTL', 300))
+)
+# bumped whenever this process changes the catalog, sent as Last-Modified
+catalog_last_modified = datetime.utcnow().replace(microsecond=0)
 
 
 class Hotel(db.Model):
@@ -24,19 +72,19 @@ class Hotel(db.Model):
     address = db.Column(db.String(255), nullable=False)
     stars = db.Column(db.Integer, nullable=True)  # Nullable for hotels without star ratings
     price = db.Column(db.Integer, nullable=False)  # Price per night
+    rooms = db.Column(db.Integer, nullable=True)  # Null means unlimited rooms
+
+    __table_args__ = (
+        db.Index('ix_hotel_city_id', 'city', 'id'),
+        db.Index('ix_hotel_city_price_id', 'city', 'price', 'id'),
+        db.Index('ix_hotel_country_city', 'country', 'city'),
+        db.Index('ix_hotel_price_id', 'price', 'id'),
+        db.Index('ix_hotel_stars_id', 'stars', 'id'),
+    )
 
     # JSON representation
     def json(self):
-        return {
-            'id': self.id,
-            'hotel_uid': self.hotel_uid,
-            'name': self.name,
-            'country': self.country,
-            'city': self.city,
-            'address': self.address,
-            'stars': self.stars,
-            'price': self.price
-        }
+        return HOTEL_ROW.from_object(self)
 
 
 class Reservation(db.Model):
@@ -49,28 +97,101 @@ class Reservation(db.Model):
     status = db.Column(db.String(20), nullable=False, default="PAID")
     start_date = db.Column(db.DateTime, nullable=False)
     end_date = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     __table_args__ = (
         db.CheckConstraint("status IN ('PAID', 'CANCELED')", name='valid_status_check'),
+        db.Index('ix_reservation_username_id', 'username', 'id'),
+        db.Index('ix_reservation_updated_at', 'updated_at'),
+        # overlap lookups on SQLite; Postgres uses the GiST range index below
+        db.Index('ix_reservation_hotel_dates', 'hotel_id', 'start_date', 'end_date'),
     )
 
     hotel = db.relationship('Hotel', backref=db.backref('reservations', lazy=True))
 
-    def json(self):
-        return {
-            'id': self.id,
-            'reservation_uid': self.reservation_uid,
-            'username': self.username,
-            'hotel_id': self.hotel.json() if self.hotel else None,
-            'status': self.status,
-            'start_date': self.start_date,
-            'end_date': self.end_date
-        }
-
+    def json(self, hotel=None):
+        if hotel is None and self.hotel:
+            hotel = self.hotel.json()
+        body = RESERVATION_ROW.from_object(self)
+        body['hotel_id'] = hotel
+        return body
+
+
+# serializers for row tuples, listings select just these columns instead of loading models
+HOTEL_ROW = RowSerializer([
+    ('id', Hotel.id),
+    ('hotel_uid', Hotel.hotel_uid),
+    ('name', Hotel.name),
+    ('country', Hotel.country),
+    ('city', Hotel.city),
+    ('address', Hotel.address),
+    ('stars', Hotel.stars),
+    ('price', Hotel.price),
+    ('rooms', Hotel.rooms)
+])
+RESERVATION_ROW = RowSerializer([
+    ('id', Reservation.id),
+    ('reservation_uid', Reservation.reservation_uid),
+    ('username', Reservation.username),
+    ('status', Reservation.status),
+    ('start_date', Reservation.start_date, iso_date),
+    ('end_date', Reservation.end_date, iso_date)
+], nested=('hotel_id', HOTEL_ROW))
+# flat rows for analytics exports
+RESERVATION_EXPORT_ROW = RowSerializer([
+    ('id', Reservation.id),
+    ('reservation_uid', Reservation.reservation_uid),
+    ('username', Reservation.username),
+    ('hotel_id', Reservation.hotel_id),
+    ('status', Reservation.status),
+    ('start_date', Reservation.start_date, iso_date),
+    ('end_date', Reservation.end_date, iso_date),
+    ('updated_at', Reservation.updated_at, iso_datetime)
+])
+
+
+#reservation rows with their hotel, in one query
+def reservation_rows(query):
+    return query.with_entities(*RESERVATION_ROW.columns).outerjoin(Hotel, Reservation.hotel_id == Hotel.id)
+
+
+OutboxEvent = outbox_model(db)
+
+
+# range index for overlap checks, only active reservations count against capacity
+RESERVATION_DDL = [
+    DDL("CREATE EXTENSION IF NOT EXISTS btree_gist").execute_if(dialect='postgresql'),
+    DDL(
+        "CREATE INDEX IF NOT EXISTS ix_reservation_hotel_stay ON reservation "
+        "USING gist (hotel_id, tsrange(start_date, end_date)) WHERE status = 'PAID'"
+    ).execute_if(dialect='postgresql')
+]
+for statement in RESERVATION_DDL:
+    event.listen(Reservation.__table__, 'after_create', statement)
 
 
 with app.app_context():
     db.create_all()
+    # databases created before rooms and the overlap indexes existed
+    upgrade_table(db, Hotel, {'rooms': None})
+    upgrade_table(db, Reservation, {'updated_at': datetime.utcnow()}, ddl=RESERVATION_DDL)
+
+
+#keep the cached loyalty profile current once an increment has been delivered
+def on_loyalty_delivered(event, response):
+    if event.target == 'loyalty' and event.path.endswith('/increment'):
+        username = event.path.split('/')[2]
+        refresh_loyalty_user(username, response)
+
+
+outbox = OutboxDispatcher(app, db, OutboxEvent, on_delivered=on_loyalty_delivered)
+register_outbox_stats_route(app, outbox)
+start_dispatcher(outbox)
+
+
+#push the reservation's status to the payment service's local copy; after a flush, so id and updated_at are set
+def publish_reservation_status(reservation, session=None):
+    outbox.enqueue('payment', 'PUT', f'/reservation-status/{reservation.id}', RESERVATION_EXPORT_ROW.from_object(reservation), session=session)
 
 #create a test route
 @app.route('/test', methods = ['GET'])
@@ -79,6 +200,74 @@ def test():
 
 logging.basicConfig(level=logging.ERROR)
 
+#hotel json by id or uid through the catalog cache, None if it does not exist
+def get_catalog_hotel(hotel_id=None, hotel_uid=None):
+    key = ('id', hotel_id) if hotel_uid is None else ('uid', hotel_uid)
+    hotel = hotel_cache.get(key)
+    if hotel is not MISSING:
+        return hotel
+
+    query = Hotel.query.filter_by(id=hotel_id) if hotel_uid is None else Hotel.query.filter_by(hotel_uid=hotel_uid)
+    row = query.first()
+    if not row:
+        return None
+
+    return remember_hotel(row.json())
+
+
+def remember_hotel(hotel):
+    hotel_cache.set(('id', hotel['id']), hotel)
+    hotel_cache.set(('uid', hotel['hotel_uid']), hotel)
+    return hotel
+
+
+#{key: hotel json} for many ids or uids, misses loaded with one IN query
+def get_catalog_hotels(keys, by='id'):
+    column = Hotel.id if by == 'id' else Hotel.hotel_uid
+    found = {}
+    misses = []
+    for key in keys:
+        hotel = hotel_cache.get((by, key))
+        if hotel is MISSING:
+            misses.append(key)
+        elif hotel is not None:
+            found[key] = hotel
+
+    if misses:
+        for row in Hotel.query.filter(column.in_(misses)).all():
+            hotel = remember_hotel(row.json())
+            found[hotel['id'] if by == 'id' else hotel['hotel_uid']] = hotel
+    return found
+
+
+def mark_catalog_modified():
+    global catalog_last_modified
+    catalog_last_modified = datetime.utcnow().replace(microsecond=0)
+
+
+def invalidate_catalog_hotel(hotel_id, hotel_uid):
+    hotel_cache.invalidate(('id', hotel_id))
+    hotel_cache.invalidate(('uid', hotel_uid))
+    mark_catalog_modified()
+
+
+#200 response with ETag / Last-Modified, 304 if the client copy is still current
+def catalog_response(body):
+    response = make_response(jsonify(body), 200)
+    response.add_etag()
+    response.last_modified = catalog_last_modified
+    return response.make_conditional(request)
+
+
+HOTEL_SORTS = {
+    'id': ([Hotel.id], False),
+    'price': ([Hotel.price, Hotel.id], False),
+    '-price': ([Hotel.price, Hotel.id], True),
+    'stars': ([Hotel.stars, Hotel.id], False),
+    '-stars': ([Hotel.stars, Hotel.id], True),
+}
+
+
 #create hotel
 @app.route('/hotel', methods=['POST'])
 def create_hotel():
@@ -93,10 +282,12 @@ def create_hotel():
             city=data['city'],
             address=data['address'],
             stars=data.get('stars'),  # Stars can be optional
-            price=data['price']
+            price=data['price'],
+            rooms=data.get('rooms')
         )
         db.session.add(new_hotel)
         db.session.commit()
+        invalidate_catalog_hotel(new_hotel.id, new_hotel.hotel_uid)
 
         return make_response(jsonify({'message': 'Hotel created successfully!'}), 201)
     except Exception as e:
@@ -104,26 +295,208 @@ def create_hotel():
         return make_response(jsonify({'message': 'Internal server error occurred.'}), 500)
 
 
-#get all hotels
+def validate_bulk_hotel(data):
+    missing = [key for key in ['name', 'country', 'city', 'address', 'price'] if data.get(key) is None]
+    if missing:
+        return None, f'Missing fields: {missing}'
+    for key in ['price', 'stars', 'rooms']:
+        if data.get(key) is not None and (not isinstance(data[key], int) or isinstance(data[key], bool)):
+            return None, f'{key} must be an integer'
+    return {
+        'hotel_uid': data.get('hotel_uid') or str(uuid.uuid4()),
+        'name': data['name'],
+        'country': data['country'],
+        'city': data['city'],
+        'address': data['address'],
+        'stars': data.get('stars'),
+        'price': data['price'],
+        'rooms': data.get('rooms')
+    }, None
+
+
+def existing_hotel_uids(hotel_uids):
+    rows = db.session.query(Hotel.hotel_uid).filter(Hotel.hotel_uid.in_(hotel_uids)).all()
+    return {row.hotel_uid for row in rows}
+
+
+#bulk create hotels from a JSON array or NDJSON body, committed in chunks
+@app.route('/hotel/bulk', methods=['POST'])
+def create_hotels_bulk():
+    try:
+        report = bulk_ingest(request, db.session, Hotel.__table__, 'hotel_uid', validate_bulk_hotel, existing_hotel_uids)
+        if report.inserted:
+            mark_catalog_modified()
+        return make_response(jsonify(report.json()), 200 if report.inserted or not report.error_count else 400)
+    except ValueError as e:
+        return make_response(jsonify({'message': str(e)}), 400)
+    except Exception as e:
+        logging.error(f"Error bulk creating hotels: {e}")
+        return make_response(jsonify({'message': 'Internal server error occurred.'}), 500)
+
+
+#catalog filters from the query string
+def filter_hotels(query, args):
+    city = args.get('city')
+    if city:
+        query = query.filter(Hotel.city == city)
+    country = args.get('country')
+    if country:
+        query = query.filter(Hotel.country == country)
+    min_stars = args.get('min_stars', type=int)
+    if min_stars is not None:
+        query = query.filter(Hotel.stars >= min_stars)
+    max_stars = args.get('max_stars', type=int)
+    if max_stars is not None:
+        query = query.filter(Hotel.stars <= max_stars)
+    min_price = args.get('min_price', type=int)
+    if min_price is not None:
+        query = query.filter(Hotel.price >= min_price)
+    max_price = args.get('max_price', type=int)
+    if max_price is not None:
+        query = query.filter(Hotel.price <= max_price)
+    return query
+
+
+#sorted page of hotels in offset or keyset mode
+def hotel_listing(query, args, conditional=True):
+    per_page = page_size(args)
+    sort = args.get('sort', 'id')
+    if sort not in HOTEL_SORTS:
+        return make_response(jsonify({'message': f'sort must be one of {list(HOTEL_SORTS)}'}), 400)
+    columns, descending = HOTEL_SORTS[sort]
+    if sort in ('stars', '-stars'):
+        # hotels without a rating cannot be ordered (or keyset-paged) by stars
+        query = query.filter(Hotel.stars.isnot(None))
+    query = query.with_entities(*HOTEL_ROW.columns)
+
+    # NDJSON mode streams every matching hotel instead of one page
+    if wants_ndjson(request):
+        order = [column.desc() for column in columns] if descending else columns
+        return ndjson_response(query.order_by(*order).yield_per(NDJSON_YIELD_PER), HOTEL_ROW)
+
+    # keyset mode, ?cursor= (empty) starts from the first page
+    if 'cursor' in args:
+        if args.get('city') and sort == 'id':
+            columns = [Hotel.city, Hotel.id]
+        hotels, next_cursor = keyset_page(query, columns, args['cursor'], per_page, descending)
+        body = {'hotels': [HOTEL_ROW(hotel) for hotel in hotels], 'next_cursor': next_cursor}
+        if flag(args, 'include_total', False):
+            body['total'] = query.count()
+    else:
+        page = args.get('page', 1, type=int)
+        include_total = flag(args, 'include_total', True)
+        order = [column.desc() for column in columns] if descending else columns
+        hotels = query.order_by(*order).paginate(page=page, per_page=per_page, error_out=False, count=include_total)
+        body = {'hotels': [HOTEL_ROW(hotel) for hotel in hotels.items]}
+        if include_total:
+            body['total'] = hotels.total
+
+    if conditional:
+        return catalog_response(body)
+    return make_response(jsonify(body), 200)
+
+
+#get all hotels, optionally filtered and sorted
 @app.route('/hotel', methods=['GET'])
+@read_only
 def get_hotels():
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
-        hotels = Hotel.query.paginate(page=page, per_page=per_page, error_out=False)
-        return make_response(jsonify({'hotels': [hotel.json() for hotel in hotels.items]}), 200)
+        return hotel_listing(filter_hotels(Hotel.query, request.args), request.args)
+    except InvalidCursorError as e:
+        return make_response(jsonify({'message': str(e)}), 400)
     except Exception as e:
         return make_response(jsonify({'message': 'Error getting hotels!'}), 500)
 
 
+#reservations whose stay intersects [start_date, end_date)
+def overlapping(start_date, end_date, dialect=None):
+    if (dialect or db.engine.dialect.name) == 'postgresql':
+        # matches the expression of the GiST index ix_reservation_hotel_stay
+        stay = func.tsrange(Reservation.start_date, Reservation.end_date)
+        return stay.op('&&')(func.tsrange(start_date, end_date))
+    return and_(Reservation.start_date < end_date, Reservation.end_date > start_date)
+
+
+#active reservations of the outer query's hotel that intersect the window
+def booked_count(start_date, end_date):
+    return (
+        select(func.count())
+        .where(Reservation.hotel_id == Hotel.id, Reservation.status == 'PAID', overlapping(start_date, end_date))
+        .correlate(Hotel)
+        .scalar_subquery()
+    )
+
+
+def parse_stay(args):
+    start_date = datetime.strptime(args['start_date'], '%Y-%m-%d')
+    end_date = datetime.strptime(args['end_date'], '%Y-%m-%d')
+    if start_date >= end_date:
+        raise ValueError('start_date must be before end_date')
+    return start_date, end_date
+
+
+#hotels with a free room for the whole window, same filters and paging as /hotel
+@app.route('/hotel/available', methods=['GET'])
+@read_only
+def get_available_hotels():
+    try:
+        try:
+            start_date, end_date = parse_stay(request.args)
+        except (KeyError, ValueError) as e:
+            return make_response(jsonify({'message': f'Invalid date range: {str(e)}'}), 400)
+
+        # evaluated per candidate hotel, so the cost follows that hotel's history, not the whole table
+        query = filter_hotels(Hotel.query, request.args).filter(
+            or_(Hotel.rooms.is_(None), booked_count(start_date, end_date) < Hotel.rooms)
+        )
+        return hotel_listing(query, request.args, conditional=False)
+    except InvalidCursorError as e:
+        return make_response(jsonify({'message': str(e)}), 400)
+    except Exception as e:
+        logging.error(f"Error searching available hotels: {e}")
+        return make_response(jsonify({'message': 'Error getting available hotels!'}), 500)
+
+
+#True if the hotel still has a free room for the whole window
+def has_free_room(hotel, start_date, end_date):
+    if hotel['rooms'] is None:
+        return True
+    # lock the hotel row so concurrent bookings for it are checked one at a time
+    Hotel.query.filter_by(id=hotel['id']).with_for_update().first()
+    booked = (
+        Reservation.query
+        .filter(Reservation.hotel_id == hotel['id'], Reservation.status == 'PAID', overlapping(start_date, end_date))
+        .count()
+    )
+    return booked < hotel['rooms']
+
+
+#get many hotels by ids or hotel_uids
+@app.route('/hotel/batch', methods=['POST'])
+@read_only
+def get_hotels_batch():
+    try:
+        data = request.get_json(silent=True) or {}
+        if 'ids' in data:
+            keys = batch_keys(data, 'ids', int)
+            return make_response(jsonify(keyed_response(keys, get_catalog_hotels(keys, by='id'))), 200)
+        keys = batch_keys(data, 'hotel_uids')
+        return make_response(jsonify(keyed_response(keys, get_catalog_hotels(keys, by='uid'))), 200)
+    except ValueError as e:
+        return make_response(jsonify({'message': str(e)}), 400)
+    except Exception as e:
+        return make_response(jsonify({'message': f'Error fetching hotels: {str(e)}'}), 500)
+
+
 #get hotel by UID
 @app.route('/hotel/<hotel_uid>', methods=['GET'])
+@read_only
 def get_hotel(hotel_uid):
     try:
-        hotel = Hotel.query.filter_by(hotel_uid=hotel_uid).first()
+        hotel = get_catalog_hotel(hotel_uid=hotel_uid)
         if not hotel:
             return make_response(jsonify({'message': 'Hotel not found!'}), 404)
-        return make_response(jsonify(hotel.json()), 200)
+        return catalog_response(hotel)
     except Exception as e:
         return make_response(jsonify({'message': f'Error fetching hotel: {str(e)}'}), 500)
 
@@ -136,8 +509,10 @@ def delete_hotel(hotel_uid):
         hotel = Hotel.query.filter_by(hotel_uid = hotel_uid).first()
 
         if hotel:
+            hotel_id = hotel.id
             db.session.delete(hotel)
             db.session.commit()
+            invalidate_catalog_hotel(hotel_id, hotel_uid)
             return make_response(jsonify({'message': 'Hotel deleted successfully!'}), 200)
         return make_response(jsonify({'message': 'Hotel not found!'}))
     
@@ -145,8 +520,31 @@ def delete_hotel(hotel_uid):
         return make_response(jsonify({'message': 'Error deleting hotel!'}), 500)
 
 
+#loyalty profile for username, None if the loyalty service does not know the user
+def get_loyalty_user(username):
+    user = loyalty_cache.get(username)
+    if user is not MISSING:
+        return user
+
+    response = loyalty_client.get(f"/loyalty/{username}")
+    if response.status_code == 404:
+        if LOYALTY_CACHE_NEGATIVE_TTL > 0:
+            loyalty_cache.set(username, None, ttl=LOYALTY_CACHE_NEGATIVE_TTL)
+        return None
+    response.raise_for_status()
+
+    user = response.json()
+    loyalty_cache.set(username, user)
+    return user
+
+
+#write-through after this service changed the count
+def refresh_loyalty_user(username, response):
+    if response.status_code == 200:
+        loyalty_cache.set(username, response.json())
+    else:
+        loyalty_cache.invalidate(username)
 
-LOYALTY_SERVICE_URL = environ.get('LOYALTY_SERVICE_URL', "http://loyalty_service:8050/loyalty")
 
 #create a reservation
 @app.route('/reservation', methods=['POST'])
@@ -158,20 +556,15 @@ def create_reservation():
         if not username:
             return make_response(jsonify({'message': 'X-User-Name header is required'}), 400)
 
-        loyalty_service_url = "http://loyalty_service:8050/loyalty"
-        response = requests.get(f"{LOYALTY_SERVICE_URL}/{username}")
-
-        if response.status_code == 404:
+        if get_loyalty_user(username) is None:
             return make_response(jsonify({'message': 'User not found in loyalty service!'}), 404)
 
-        loyalty_user = response.json()
-
         # Validate input data
         required_fields = ['hotel_id', 'start_date', 'end_date']
         if not data or not all(field in data for field in required_fields):
             return make_response(jsonify({'message': 'Invalid input data!'}), 400)
 
-        hotel = Hotel.query.filter_by(id=data['hotel_id']).first()
+        hotel = get_catalog_hotel(hotel_id=data['hotel_id'])
         if not hotel:
             return make_response(jsonify({'message': 'Hotel not found!'}), 404)
 
@@ -180,6 +573,10 @@ def create_reservation():
         if start_date >= end_date:
             return make_response(jsonify({'message': 'Invalid date range!'}), 400)
 
+        if not has_free_room(hotel, start_date, end_date):
+            db.session.rollback()
+            return make_response(jsonify({'message': 'No rooms available for these dates!'}), 409)
+
         # Create reservation
         new_reservation = Reservation(
             hotel_id=data['hotel_id'],
@@ -188,17 +585,21 @@ def create_reservation():
             end_date=end_date
         )
         db.session.add(new_reservation)
-        db.session.commit()
-
-        # Notify loyalty service
-        update_payload = {"reservation_count": loyalty_user["reservation_count"] + 1}
-        patch_response = requests.patch(f"{loyalty_service_url}/{username}/", json=update_payload)
 
-        if patch_response.status_code != 200:
-            return make_response(jsonify({'message': 'Error updating loyalty data'}), patch_response.status_code)
+        # Notify loyalty service through the outbox, committed together with the reservation
+        outbox.enqueue('loyalty', 'POST', f"/loyalty/{username}/increment", {"delta": 1})
+        db.session.flush()
+        publish_reservation_status(new_reservation)
+        body = new_reservation.json(hotel=hotel)
+        db.session.commit()
+        outbox.wake()
 
-        return make_response(jsonify(new_reservation.json()), 201)
+        return make_response(jsonify(body), 201)
 
+    except (ServiceUnavailableError, requests.RequestException) as e:
+        db.session.rollback()
+        logging.error(f"Loyalty service unavailable: {e}")
+        return make_response(jsonify({'message': 'Loyalty service unavailable'}), 503)
     except Exception as e:
         logging.error(f"Error creating reservation: {e}")
         return make_response(jsonify({'message': 'Internal server error occurred.'}), 500)
@@ -206,6 +607,7 @@ def create_reservation():
 
 #get all reservations
 @app.route('/reservation', methods=['GET'])
+@read_only
 def get_user_reservations():
     try:
         username = request.headers.get('X-User-Name')
@@ -213,9 +615,31 @@ def get_user_reservations():
         if not username:
             return make_response(jsonify({'message': 'X-User-Name header is required'}), 400)
 
-        reservations = Reservation.query.filter_by(username=username).all()
-        return make_response(jsonify({'reservations': [r.json() for r in reservations]}), 200)
+        # hotels are read in the same query instead of one lazy SELECT per row
+        query = reservation_rows(Reservation.query).filter(Reservation.username == username)
+
+        status = request.args.get('status')
+        if status:
+            query = query.filter(Reservation.status == status)
+
+        # date window, keeps reservations whose stay overlaps [from, to)
+        date_from = request.args.get('from')
+        if date_from:
+            query = query.filter(Reservation.end_date > datetime.strptime(date_from, '%Y-%m-%d'))
+        date_to = request.args.get('to')
+        if date_to:
+            query = query.filter(Reservation.start_date < datetime.strptime(date_to, '%Y-%m-%d'))
 
+        if wants_ndjson(request):
+            return ndjson_response(query.order_by(Reservation.id).yield_per(NDJSON_YIELD_PER), RESERVATION_ROW)
+
+        reservations, next_cursor = keyset_page(
+            query, [Reservation.id], request.args.get('cursor'), page_size(request.args, default=50)
+        )
+        return make_response(jsonify({'reservations': [RESERVATION_ROW(r) for r in reservations], 'next_cursor': next_cursor}), 200)
+
+    except (InvalidCursorError, ValueError) as e:
+        return make_response(jsonify({'message': f'Invalid query parameters: {str(e)}'}), 400)
     except Exception as e:
         return make_response(jsonify({'message': f'Error retrieving reservations: {str(e)}'}), 500)
 
@@ -223,38 +647,34 @@ def get_user_reservations():
 @app.route('/reservations/<reservation_uid>', methods=['DELETE'])
 def cancel_reservation(reservation_uid):
     try:
-        reservation = Reservation.query.filter_by(reservation_uid=reservation_uid).first()
+        # locked, so of two concurrent cancels only one sees the reservation active
+        reservation = Reservation.query.filter_by(reservation_uid=reservation_uid).with_for_update().first()
         if not reservation:
             return make_response(jsonify({'message': 'Reservation not found!'}), 404)
+        if reservation.status == 'CANCELED':
+            # a repeated cancel must not take another reservation off the loyalty count
+            db.session.rollback()
+            return make_response(jsonify({'message': 'Reservation canceled successfully!'}), 200)
 
         reservation.status = 'CANCELED'
-        db.session.commit()
+        db.session.flush()
+        publish_reservation_status(reservation)
 
-        # Notify the loyalty service to decrement the reservation count
-        username = reservation.username
-        loyalty_service_url = "http://loyalty_service:8050/loyalty"
-        response = requests.get(f"{loyalty_service_url}/{username}")
-
-        if response.status_code != 200:
-            return make_response(jsonify({'message': 'Error fetching loyalty user'}), response.status_code)
-
-        loyalty_user = response.json()
-        new_count = max(0, loyalty_user["reservation_count"] - 1)  # Ensure count doesn't go below 0
-
-        # Send PATCH request to update the reservation count
-        patch_response = requests.patch(f"{loyalty_service_url}/{username}/", json={"reservation_count": new_count})
-
-        if patch_response.status_code != 200:
-            return make_response(jsonify({'message': 'Error updating loyalty user'}), patch_response.status_code)
+        # Notify the loyalty service to decrement the reservation count (clamped at 0 there)
+        outbox.enqueue('loyalty', 'POST', f"/loyalty/{reservation.username}/increment", {"delta": -1})
+        db.session.commit()
+        outbox.wake()
 
         return make_response(jsonify({'message': 'Reservation canceled successfully!'}), 200)
 
     except Exception as e:
+        db.session.rollback()
         return make_response(jsonify({'message': f'Error canceling reservation: {str(e)}'}), 500)
 
 
 #get reservation by uid
 @app.route('/reservations/<reservation_uid>', methods=['GET'])
+@read_only
 def get_reservation(reservation_uid):
     reservation = Reservation.query.filter_by(reservation_uid=reservation_uid).first()
     if not reservation:
@@ -262,6 +682,33 @@ def get_reservation(reservation_uid):
     return jsonify(reservation.json()), 200
 
 
+#stream all reservations as NDJSON or CSV, ?after_id= / ?since= (updated_at) for incremental pulls
+@app.route('/reservations/export', methods=['GET'])
+@read_only
+def export_reservations():
+    try:
+        return export_response(request.args, Reservation.query, RESERVATION_EXPORT_ROW, Reservation.id, Reservation.updated_at)
+    except ValueError as e:
+        return make_response(jsonify({'message': f'Invalid query parameters: {str(e)}'}), 400)
+    except Exception as e:
+        return make_response(jsonify({'message': f'Error exporting reservations: {str(e)}'}), 500)
+
+
+#get many reservations by reservation_uids
+@app.route('/reservations/batch', methods=['POST'])
+@read_only
+def get_reservations_batch():
+    try:
+        keys = batch_keys(request.get_json(silent=True), 'reservation_uids')
+        reservations = reservation_rows(Reservation.query).filter(Reservation.reservation_uid.in_(keys)).all()
+        found = {r.reservation_uid: RESERVATION_ROW(r) for r in reservations}
+        return make_response(jsonify(keyed_response(keys, found)), 200)
+    except ValueError as e:
+        return make_response(jsonify({'message': str(e)}), 400)
+    except Exception as e:
+        return make_response(jsonify({'message': f'Error retrieving reservations: {str(e)}'}), 500)
+
+
 #update reservation status
 @app.route('/reservations/<reservation_uid>', methods=['PATCH'])
 def update_reservation_status(reservation_uid):
@@ -286,13 +733,24 @@ def update_reservation_status(reservation_uid):
         if not reservation:
             return make_response(jsonify({'message': 'Reservation not found!'}), 404)
 
+        # re-activating a cancelled stay takes a room again, same locked check as a new booking
+        if new_status == 'PAID' and reservation.status != 'PAID':
+            hotel = get_catalog_hotel(hotel_id=reservation.hotel_id)
+            if hotel and not has_free_room(hotel, reservation.start_date, reservation.end_date):
+                db.session.rollback()
+                return make_response(jsonify({'message': 'No rooms available for these dates!'}), 409)
+
         # Update the status
         reservation.status = new_status
+        db.session.flush()
+        publish_reservation_status(reservation)
         db.session.commit()
+        outbox.wake()
 
         return make_response(jsonify({'message': f'Reservation status updated to {new_status}!'}), 200)
 
     except Exception as e:
+        db.session.rollback()
         return make_response(jsonify({'message': f'Error updating reservation status: {str(e)}'}), 500)
 
 if __name__ == "__main__":
@@ -0,0 +1,240 @@
+"""Asyncio serving mode for the reservation service.
+
+POST /reservation runs on an asyncio stack (Quart, SQLAlchemy asyncio, httpx),
+so a single process holds many bookings in flight while they wait on Postgres
+or the loyalty service. Every other route falls through to the Flask app.
+Async routes go through the same admission limits as their Flask versions.
+
+    uvicorn async_app:application --host 0.0.0.0 --port 8070
+"""
+from quart import Quart, request, jsonify, make_response
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from werkzeug.exceptions import HTTPException
+from a2wsgi import WSGIMiddleware
+from datetime import datetime
+from functools import wraps
+from os import environ
+import asyncio
+import logging
+import httpx
+import app as flask_service
+from app import Hotel, Reservation, hotel_cache, loyalty_cache, LOYALTY_CACHE_NEGATIVE_TTL, remember_hotel, overlapping
+from common.async_service_client import async_service_client
+from common.service_client import ServiceUnavailableError
+from common.cache import MISSING
+from common.admission import ADMISSION_ENABLED, ADMISSION_RETRY_AFTER, admission_rejections, admission_queue_time, retry_after
+from common.metrics import REGISTRY, request_timer, _instrument_engine as instrument_db_metrics
+from common.tracing import start_span, parse_traceparent, _instrument_engine as instrument_db_tracing
+
+
+app = Quart(__name__)
+
+loyalty_client = async_service_client('loyalty')
+engine = None
+Session = None
+
+
+def async_db_url(url):
+    if url.startswith('postgresql://'):
+        return 'postgresql+asyncpg://' + url[len('postgresql://'):]
+    if url.startswith('sqlite://'):
+        return 'sqlite+aiosqlite://' + url[len('sqlite://'):]
+    return url
+
+
+@app.before_serving
+async def open_connections():
+    global engine, Session
+    url = async_db_url(environ.get('DB_URL'))
+    if url.startswith('postgresql'):
+        options = {
+            'pool_size': int(environ.get('ASYNC_DB_POOL_SIZE', 20)),
+            'max_overflow': int(environ.get('ASYNC_DB_MAX_OVERFLOW', 20)),
+            'pool_pre_ping': True
+        }
+    else:
+        # SQLite takes one writer at a time; queueing on a single connection
+        # beats many connections sleeping in the busy handler
+        options = {'pool_size': 1, 'max_overflow': 0, 'pool_timeout': 60}
+    engine = create_async_engine(url, **options)
+    # the statements run on the sync engine underneath, its events feed the same db metrics and spans
+    instrument_db_metrics(engine.sync_engine)
+    instrument_db_tracing(engine.sync_engine)
+    Session = async_sessionmaker(engine, expire_on_commit=False)
+    loyalty_client.open()
+
+
+@app.after_serving
+async def close_connections():
+    await loyalty_client.aclose()
+    await engine.dispose()
+
+
+async def get_loyalty_user(username):
+    user = loyalty_cache.get(username)
+    if user is not MISSING:
+        return user
+
+    response = await loyalty_client.get(f"/loyalty/{username}")
+    if response.status_code == 404:
+        if LOYALTY_CACHE_NEGATIVE_TTL > 0:
+            loyalty_cache.set(username, None, ttl=LOYALTY_CACHE_NEGATIVE_TTL)
+        return None
+    response.raise_for_status()
+
+    user = response.json()
+    loyalty_cache.set(username, user)
+    return user
+
+
+async def get_catalog_hotel(hotel_id):
+    hotel = hotel_cache.get(('id', hotel_id))
+    if hotel is not MISSING:
+        return hotel
+
+    async with Session() as session:
+        row = (await session.execute(select(Hotel).where(Hotel.id == hotel_id))).scalar_one_or_none()
+    if row is None:
+        return None
+    return remember_hotel(row.json())
+
+
+async def has_free_room(session, hotel, start_date, end_date):
+    if hotel['rooms'] is None:
+        return True
+    await session.execute(select(Hotel.id).where(Hotel.id == hotel['id']).with_for_update())
+    booked = await session.scalar(
+        select(func.count())
+        .select_from(Reservation)
+        .where(
+            Reservation.hotel_id == hotel['id'],
+            Reservation.status == 'PAID',
+            overlapping(start_date, end_date, engine.dialect.name)
+        )
+    )
+    return booked < hotel['rooms']
+
+
+async def too_busy(message, status, seconds):
+    response = await make_response(jsonify({'message': message}), status)
+    response.headers['Retry-After'] = retry_after(seconds)
+    return response
+
+
+#the Flask app's admission checks for an async view, sharing its slots and buckets
+def admitted(view):
+    route = flask_service.admission.get(view.__name__)
+
+    @wraps(view)
+    async def wrapper(*args, **kwargs):
+        if route is None or not ADMISSION_ENABLED:
+            return await view(*args, **kwargs)
+        rule = (('route', request.url_rule.rule),)
+
+        wait = route.check_rate(request.headers.get('X-User-Name'))
+        if wait:
+            REGISTRY.inc(admission_rejections, rule + (('reason', 'rate_limited'),))
+            return await too_busy('Too many requests, slow down', 429, wait)
+
+        ok, reason, waited = await route.acquire_async()
+        if not ok:
+            REGISTRY.inc(admission_rejections, rule + (('reason', reason),))
+            return await too_busy('Service is busy, try again later', 503, ADMISSION_RETRY_AFTER)
+        REGISTRY.observe(admission_queue_time, rule, waited)
+        try:
+            return await view(*args, **kwargs)
+        finally:
+            route.release()
+    return wrapper
+
+
+#create a reservation
+@app.route('/reservation', methods=['POST'])
+@admitted
+async def create_reservation():
+    try:
+        data = await request.get_json()
+        username = request.headers.get('X-User-Name')
+
+        if not username:
+            return await make_response(jsonify({'message': 'X-User-Name header is required'}), 400)
+
+        # Validate input data
+        required_fields = ['hotel_id', 'start_date', 'end_date']
+        if not data or not all(field in data for field in required_fields):
+            return await make_response(jsonify({'message': 'Invalid input data!'}), 400)
+
+        try:
+            start_date = datetime.strptime(data['start_date'], '%Y-%m-%d')
+            end_date = datetime.strptime(data['end_date'], '%Y-%m-%d')
+        except (TypeError, ValueError):
+            return await make_response(jsonify({'message': 'Invalid date range!'}), 400)
+        if start_date >= end_date:
+            return await make_response(jsonify({'message': 'Invalid date range!'}), 400)
+
+        # the loyalty lookup and the hotel lookup do not depend on each other
+        loyalty_user, hotel = await asyncio.gather(get_loyalty_user(username), get_catalog_hotel(data['hotel_id']))
+        if loyalty_user is None:
+            return await make_response(jsonify({'message': 'User not found in loyalty service!'}), 404)
+        if not hotel:
+            return await make_response(jsonify({'message': 'Hotel not found!'}), 404)
+
+        async with Session() as session:
+            if not await has_free_room(session, hotel, start_date, end_date):
+                await session.rollback()
+                return await make_response(jsonify({'message': 'No rooms available for these dates!'}), 409)
+
+            new_reservation = Reservation(
+                hotel_id=hotel['id'],
+                username=username,
+                start_date=start_date,
+                end_date=end_date
+            )
+            session.add(new_reservation)
+            flask_service.outbox.enqueue('loyalty', 'POST', f"/loyalty/{username}/increment", {"delta": 1}, session=session)
+            await session.flush()
+            flask_service.publish_reservation_status(new_reservation, session=session)
+            body = new_reservation.json(hotel=hotel)
+            await session.commit()
+        flask_service.outbox.wake()
+
+        return await make_response(jsonify(body), 201)
+
+    except (ServiceUnavailableError, httpx.HTTPError) as e:
+        logging.error(f"Loyalty service unavailable: {e}")
+        return await make_response(jsonify({'message': 'Loyalty service unavailable'}), 503)
+    except Exception as e:
+        logging.error(f"Error creating reservation: {e}")
+        return await make_response(jsonify({'message': 'Internal server error occurred.'}), 500)
+
+
+flask_app = WSGIMiddleware(flask_service.app)
+async_routes = app.url_map.bind('localhost')
+
+
+#server span and request metrics around an async route, the Flask routes record their own
+async def traced(scope, receive, send, rule):
+    traceparent = dict(scope['headers']).get(b'traceparent', b'').decode('latin-1')
+    with request_timer(rule.rule, scope['method']) as counts, \
+            start_span(f"{scope['method']} {rule.rule}", 'server', parse_traceparent(traceparent)) as span:
+        async def send_with_trace_id(message):
+            if message['type'] == 'http.response.start':
+                span.attributes['status'] = counts['status'] = message['status']
+                message['headers'] = list(message.get('headers', [])) + [(b'x-trace-id', span.trace_id.encode())]
+            await send(message)
+
+        await app(scope, receive, send_with_trace_id)
+
+
+#ASGI entry point: routes defined above run async, the rest go to the Flask app
+async def application(scope, receive, send):
+    if scope['type'] == 'http':
+        try:
+            rule, _ = async_routes.match(scope['path'], method=scope['method'], return_rule=True)
+        except HTTPException:
+            await flask_app(scope, receive, send)
+            return
+        await traced(scope, receive, send, rule)
+        return
+    await app(scope, receive, send)